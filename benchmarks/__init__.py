@@ -0,0 +1,5 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
@@ -0,0 +1,246 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import argh
+import datetime
+import json
+import pathlib
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+import benchmarks.tree
+import timewarp.service.boot
+import timewarp.service.snapper
+
+
+class Benchmark(object):
+    """
+    Benchmark measuring snapshot creation, clean-up, reconciliation and boot
+    loader entry handling as the number of boot environments grows.
+    """
+
+    def __init__(
+            self, path: pathlib.Path, database: str, loader: str,
+            packages: int, image_size: int, samples: int) -> None:
+        self._path = path
+        self._database = database
+        self._loader = loader
+        self._packages = packages
+        self._image_size = image_size
+        self._samples = samples
+
+    def run(self, size: int) -> typing.Mapping[str, typing.Any]:
+        """
+        Runs all benchmarks with a given number of boot environments and
+        returns the results.
+
+        Keyword arguments:
+        size -- the number of boot environments
+        """
+        path = self._path / str(size)
+        tree = benchmarks.tree.Tree(
+            path, self._database, self._loader, self._packages,
+            self._image_size)
+        results = {}
+
+        try:
+            numbers = tree.populate(size)
+
+            # A missing state index forces querying the package databases of
+            # all boot environments.
+            timings = []
+
+            for _ in range(self._samples):
+                shutil.rmtree(tree.state, ignore_errors=True)
+                service = tree.create_service()
+                timings.append(self._time(service._reconcile))
+
+            results["reconcile.verify"] = timings
+            results["reconcile"] = [
+                self._time(tree.create_service()._reconcile)
+                for _ in range(self._samples)]
+
+            # Fill the boot loader with the entries of the existing boot
+            # environments.
+            service = tree.create_service()
+            service._reconcile()
+
+            for number in numbers:
+                service._loader.add_entry(number, self._entry(service, number))
+
+            # Boot loader entry handling on its own.
+            first = size + 1
+            extra = range(first, first + self._samples)
+            results["loader.add_entry"] = [
+                self._time(
+                    service._loader.add_entry, number,
+                    self._entry(service, number))
+                for number in extra]
+            results["loader.remove_entry"] = [
+                self._time(service._loader.remove_entry, number)
+                for number in extra]
+
+            for number in extra:
+                service._loader.add_entry(number, self._entry(service, number))
+
+            results["loader.remove_entries"] = [
+                self._time(service._loader.remove_entries, list(extra))]
+
+            # Snapshot creation including the fake snapperd, followed by the
+            # clean-up of the snapshots which have been deleted afterwards.
+            created = []
+            results["create"] = []
+
+            for _ in range(self._samples):
+                start = time.perf_counter()
+                number = service._create_snapshot(
+                    timewarp.service.snapper.SnapshotType.SINGLE, {})
+                results["create"].append(time.perf_counter() - start)
+
+                if not number:
+                    raise RuntimeError(
+                        "Snapshot creation failed, check the syslog")
+
+                created.append(number)
+
+            for number in created:
+                shutil.rmtree(tree.snapshots / str(number))
+
+            results["cleanup"] = [
+                self._time(service._clean_up, [number]) for number in created]
+
+            created = [
+                service._create_snapshot(
+                    timewarp.service.snapper.SnapshotType.SINGLE, {})
+                for _ in range(self._samples)]
+
+            for number in created:
+                shutil.rmtree(tree.snapshots / str(number))
+
+            results["cleanup.batch"] = [
+                self._time(service._clean_up, created)]
+
+            # Bulk creation and deletion of boot environments for existing
+            # snapshots.
+            created = [tree.create_snapshot() for _ in range(self._samples)]
+            results["bulk.create"] = [
+                self._time(service.CreateBootEnvironments, created)]
+            results["bulk.delete"] = [
+                self._time(service.DeleteBootEnvironments, created)]
+            stages = service._metrics.get()
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+        return {
+            "size": size,
+            "results": {
+                name: self._summarize(timings)
+                for name, timings in results.items()},
+            "stages": {
+                name: {
+                    "count": count, "sum": total, "p50": p50, "p95": p95,
+                    "p99": p99}
+                for name, (count, total, p50, p95, p99) in stages.items()}
+        }
+
+    def _entry(
+            self, service: typing.Any,
+            number: int) -> timewarp.service.boot.Entry:
+        mapping = {
+            **service._default_mapping,
+            "snapshot": timewarp.service.snapper.Snapshot(
+                number, 0, 0, 0, 0, "timewarp", "number", {}),
+            "linux": service._root_database.get_packages_by_name("linux")[-1]
+        }
+        return timewarp.service.boot.Entry(**service._configuration.format(
+            mapping, service._configuration.boot.entry))
+
+    def _summarize(
+            self,
+            timings: typing.Sequence[float]) -> typing.Mapping[str, float]:
+        return {
+            "samples": len(timings),
+            "min": min(timings),
+            "median": statistics.median(timings),
+            "mean": statistics.mean(timings),
+            "max": max(timings)
+        }
+
+    def _time(
+            self, function: typing.Callable[..., typing.Any],
+            *args: typing.Iterable[typing.Any]) -> float:
+        start = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - start
+
+
+@argh.arg("-s", "--sizes", nargs="+", type=int)
+@argh.arg("-d", "--database", choices=["alpm", "dpkg"])
+@argh.arg("-l", "--loader", choices=["grub", "systemdboot"])
+def run(
+        sizes: typing.List[int] = [10, 100, 1000], samples: int = 10,
+        database: str = "alpm", loader: str = "systemdboot",
+        packages: int = 50, image_size: int = 8, directory: str = None,
+        output: str = None) -> None:
+    """
+    Runs the benchmarks for each number of boot environments and writes the
+    results as JSON.  All times are in seconds.
+
+    Keyword arguments:
+    sizes      -- the numbers of boot environments
+    samples    -- the number of samples per benchmark and size
+    database   -- the package database type
+    loader     -- the boot loader
+    packages   -- the number of packages in each package database
+    image_size -- the kernel image size in MiB
+    directory  -- the scratch directory (default: a temporary directory)
+    output     -- the output file (default: stdout)
+    """
+    with tempfile.TemporaryDirectory(
+            prefix="timewarp-benchmark-", dir=directory) as path:
+        benchmark = Benchmark(
+            pathlib.Path(path), database, loader, packages,
+            image_size * 1024 * 1024, samples)
+        results = {
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "parameters": {
+                "samples": samples,
+                "database": database,
+                "loader": loader,
+                "packages": packages,
+                "image_size": image_size
+            },
+            "sizes": []
+        }
+
+        for size in sorted(sizes):
+            print(f"Benchmarking {size} boot environments...", file=sys.stderr)
+            results["sizes"].append(benchmark.run(size))
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+def main(args: typing.List[str] = None) -> None:
+    """Entry point."""
+    parser = argh.ArghParser(prog="benchmarks")
+    argh.set_default_command(parser, run)
+    parser.dispatch(args if args is not None else sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import argh
+from gi.repository import GLib
+import os
+import pathlib
+import pydbus
+import pydbus.generic
+import shutil
+import signal
+import sys
+import threading
+import time
+import typing
+
+import benchmarks.tree
+import timewarp.service.btrfs
+import timewarp.service.snapper
+
+
+class Snapperd(object):
+    """
+    <node>
+        <interface name="org.opensuse.Snapper">
+            <method name="CreateSingleSnapshot">
+                <arg type="s" name="config_name" direction="in"/>
+                <arg type="s" name="description" direction="in"/>
+                <arg type="s" name="cleanup" direction="in"/>
+                <arg type="a{ss}" name="userdata" direction="in"/>
+                <arg type="u" name="number" direction="out"/>
+            </method>
+            <method name="CreatePreSnapshot">
+                <arg type="s" name="config_name" direction="in"/>
+                <arg type="s" name="description" direction="in"/>
+                <arg type="s" name="cleanup" direction="in"/>
+                <arg type="a{ss}" name="userdata" direction="in"/>
+                <arg type="u" name="number" direction="out"/>
+            </method>
+            <method name="CreatePostSnapshot">
+                <arg type="s" name="config_name" direction="in"/>
+                <arg type="u" name="pre_number" direction="in"/>
+                <arg type="s" name="description" direction="in"/>
+                <arg type="s" name="cleanup" direction="in"/>
+                <arg type="a{ss}" name="userdata" direction="in"/>
+                <arg type="u" name="number" direction="out"/>
+            </method>
+            <method name="GetSnapshot">
+                <arg type="s" name="config_name" direction="in"/>
+                <arg type="u" name="number" direction="in"/>
+                <arg type="(uquxussa{ss})" name="snapshot" direction="out"/>
+            </method>
+            <method name="ListSnapshots">
+                <arg type="s" name="config_name" direction="in"/>
+                <arg type="a(uquxussa{ss})" name="snapshots" direction="out"/>
+            </method>
+            <method name="DeleteSnapshots">
+                <arg type="s" name="config_name" direction="in"/>
+                <arg type="au" name="numbers" direction="in"/>
+            </method>
+            <signal name="SnapshotCreated">
+                <arg type="s" name="config_name"/>
+                <arg type="u" name="number"/>
+            </signal>
+            <signal name="SnapshotsDeleted">
+                <arg type="s" name="config_name"/>
+                <arg type="au" name="numbers"/>
+            </signal>
+        </interface>
+    </node>
+    """
+
+    """
+    Local snapperd stand-in.  Snapshots of a source subvolume are created in
+    a snapshot directory laid out like /.snapshots, either as read-only Btrfs
+    snapshots like snapper does or as hard-linked directory trees.
+    """
+
+    SnapshotCreated = pydbus.generic.signal()
+    SnapshotsDeleted = pydbus.generic.signal()
+
+    def __init__(
+            self, source: pathlib.Path, snapshots: pathlib.Path,
+            latency: float = 0.0, directory: bool = False) -> None:
+        self._source = source
+        self._snapshots = snapshots
+        self._latency = latency
+        self._btrfs = timewarp.service.btrfs.Btrfs() \
+            if not directory else None
+        self._lock = threading.Lock()
+        self._info = {}
+
+        self._snapshots.mkdir(parents=True, exist_ok=True)
+
+        # Snapshots left over from an earlier run are listed as single
+        # snapshots.
+        for path in self._snapshots.glob("*"):
+            if path.name.isdigit():
+                self._info[int(path.name)] = (
+                    int(path.name),
+                    timewarp.service.snapper.SnapshotType.SINGLE.value, 0,
+                    int(path.stat().st_mtime), os.getuid(), "", "", {})
+
+    def CreateSingleSnapshot(
+            self, config_name: str, description: str, cleanup: str,
+            userdata: typing.Mapping[str, str]) -> int:
+        """Creates a new single snapshot, returning the snapshot number."""
+        return self._create_snapshot(
+            config_name, timewarp.service.snapper.SnapshotType.SINGLE, 0,
+            description, cleanup, userdata)
+
+    def CreatePreSnapshot(
+            self, config_name: str, description: str, cleanup: str,
+            userdata: typing.Mapping[str, str]) -> int:
+        """Creates a new pre-snapshot, returning the snapshot number."""
+        return self._create_snapshot(
+            config_name, timewarp.service.snapper.SnapshotType.PRE, 0,
+            description, cleanup, userdata)
+
+    def CreatePostSnapshot(
+            self, config_name: str, pre_number: int, description: str,
+            cleanup: str, userdata: typing.Mapping[str, str]) -> int:
+        """Creates a new post-snapshot, returning the snapshot number."""
+        return self._create_snapshot(
+            config_name, timewarp.service.snapper.SnapshotType.POST,
+            pre_number, description, cleanup, userdata)
+
+    def GetSnapshot(
+            self, config_name: str, number: int) -> typing.Tuple[
+            int, int, int, int, int, str, str, typing.Mapping[str, str]]:
+        """Returns a snapshot."""
+        with self._lock:
+            return self._info[number]
+
+    def ListSnapshots(self, config_name: str) -> typing.List[typing.Tuple[
+            int, int, int, int, int, str, str, typing.Mapping[str, str]]]:
+        """Returns all snapshots."""
+        with self._lock:
+            return [self._info[number] for number in sorted(self._info)]
+
+    def DeleteSnapshots(
+            self, config_name: str, numbers: typing.List[int]) -> None:
+        """Deletes snapshots."""
+        time.sleep(self._latency)
+
+        paths = [
+            self._snapshots / str(number) / "snapshot" for number in numbers]
+
+        if self._btrfs is not None:
+            self._btrfs.delete([path for path in paths if path.exists()])
+
+        with self._lock:
+            for number in numbers:
+                shutil.rmtree(self._snapshots / str(number), True)
+                self._info.pop(number, None)
+
+        self.SnapshotsDeleted(config_name, numbers)
+
+    def _create_snapshot(
+            self, config_name: str,
+            type: timewarp.service.snapper.SnapshotType, pre_number: int,
+            description: str, cleanup: str,
+            userdata: typing.Mapping[str, str]) -> int:
+        # Simulate the latency of snapperd, e.g. running its own hooks.
+        time.sleep(self._latency)
+
+        with self._lock:
+            number = max(self._info, default=0) + 1
+            path = self._snapshots / str(number)
+            path.mkdir()
+
+            if self._btrfs is not None:
+                self._btrfs.snapshot(
+                    self._source, path / "snapshot", read_only=True)
+            else:
+                benchmarks.tree.clone(self._source, path / "snapshot")
+
+            self._info[number] = (
+                number, type.value, pre_number, int(time.time()),
+                os.getuid(), description, cleanup, dict(userdata))
+
+        self.SnapshotCreated(config_name, number)
+        return number
+
+
+@argh.arg("-s", "--source", required=True)
+@argh.arg("-d", "--snapshots", required=True)
+def run(
+        source: str = None, snapshots: str = None, latency: float = 0.0,
+        directory: bool = False) -> None:
+    """
+    Runs the snapperd stand-in on the D-Bus session bus until interrupted.
+    Start timewarpd with --session-bus to use it, or benchmarks.timewarpd
+    with --directory.  Unless --directory is passed, the source and the
+    snapshot directory have to be on the same Btrfs file system.
+
+    Keyword arguments:
+    source    -- the subvolume to snapshot
+    snapshots -- the snapshot directory
+    latency   -- the time in seconds each snapshot creation and deletion
+                 takes at least
+    directory -- create hard-linked directory trees instead of Btrfs
+                 snapshots
+    """
+    loop = GLib.MainLoop()
+    pydbus.SessionBus().publish(
+        "org.opensuse.Snapper", Snapperd(
+            pathlib.Path(source), pathlib.Path(snapshots), latency,
+            directory))
+    signal.signal(signal.SIGINT, lambda signum, frame: loop.quit())
+    signal.signal(signal.SIGTERM, lambda signum, frame: loop.quit())
+    loop.run()
+
+
+def main(args: typing.List[str] = None) -> None:
+    """Entry point."""
+    parser = argh.ArghParser(prog="snapperd")
+    argh.set_default_command(parser, run)
+    parser.dispatch(args if args is not None else sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
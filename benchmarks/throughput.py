@@ -0,0 +1,96 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import argh
+import concurrent.futures
+import json
+import pydbus
+import statistics
+import sys
+import time
+import typing
+
+
+@argh.arg("-t", "--type", choices=["pre-post", "single"])
+def run(
+        calls: int = 100, concurrency: int = 1, type: str = "single",
+        delete: bool = False, output: str = None) -> None:
+    """
+    Creates snapshots through timewarpd on the D-Bus session bus as fast as
+    possible and writes the throughput and latencies as JSON.  timewarpd has
+    to be started with --session-bus, together with the snapperd stand-in.
+
+    Keyword arguments:
+    calls       -- the number of snapshots to create
+    concurrency -- the number of concurrent callers
+    type        -- "pre-post" to create pairs of pre- and post-snapshots or
+                   "single" to create single snapshots
+    delete      -- delete the snapshots via the snapperd stand-in afterwards
+    output      -- the output file (default: stdout)
+    """
+    bus = pydbus.SessionBus()
+    service = bus.get("com.branchonequal.TimeWarp")
+
+    def create(call: int) -> typing.Tuple[float, typing.List[int]]:
+        start = time.perf_counter()
+
+        # Each pair uses its own session so that concurrent callers do not
+        # pair each other's pre- and post-snapshots.
+        if "pre-post" == type:
+            session = f"throughput-{call}"
+            numbers = [
+                service.CreateSessionPreSnapshot(session, False),
+                service.CreateSessionPostSnapshot(session)]
+        else:
+            numbers = [service.CreateSingleSnapshot(False)]
+
+        return time.perf_counter() - start, numbers
+
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(create, range(calls)))
+
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    numbers = [number for _, numbers in results for number in numbers]
+
+    if delete:
+        bus.get("org.opensuse.Snapper").DeleteSnapshots(
+            "root", [number for number in numbers if number])
+
+    result = {
+        "calls": calls,
+        "concurrency": concurrency,
+        "type": type,
+        "failed": numbers.count(0),
+        "elapsed": elapsed,
+        "throughput": calls / elapsed,
+        "latency": {
+            "min": min(latencies),
+            "median": statistics.median(latencies),
+            "mean": statistics.mean(latencies),
+            "max": max(latencies)
+        }
+    }
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+def main(args: typing.List[str] = None) -> None:
+    """Entry point."""
+    parser = argh.ArghParser(prog="throughput")
+    argh.set_default_command(parser, run)
+    parser.dispatch(args if args is not None else sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
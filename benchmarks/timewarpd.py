@@ -0,0 +1,46 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import argh
+import sys
+import typing
+
+import benchmarks.tree
+import timewarp.error
+import timewarp.service.__main__
+
+
+def run(verify: bool = False, directory: bool = False) -> None:
+    """
+    Runs timewarpd on the D-Bus session bus until interrupted, for driving
+    it with the throughput benchmark together with the snapperd stand-in.
+
+    Keyword arguments:
+    verify    -- verify the state index against the boot environments and
+                 repair it
+    directory -- create and delete boot environments as hard-linked
+                 directory trees instead of Btrfs snapshots, for use with
+                 the snapperd stand-in started with --directory
+    """
+    try:
+        service = timewarp.service.__main__.Service(
+            verify, True,
+            btrfs=benchmarks.tree.Btrfs() if directory else None)
+        service.start()
+    except timewarp.error.InitializationError as e:
+        print(f"Failed to start timewarpd: {e.message}.")
+        exit(-1)
+
+
+def main(args: typing.List[str] = None) -> None:
+    """Entry point."""
+    parser = argh.ArghParser(prog="timewarpd")
+    argh.set_default_command(parser, run)
+    parser.dispatch(args if args is not None else sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
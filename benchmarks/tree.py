@@ -0,0 +1,339 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+from gi.repository import GLib
+import json
+import os
+import pathlib
+import shutil
+import time
+import typing
+
+import timewarp.configuration
+import timewarp.error
+import timewarp.namespace
+import timewarp.service.__main__
+import timewarp.service.boot.loader.grub
+import timewarp.service.boot.loader.systemdboot
+import timewarp.service.snapper
+
+_MACHINE_ID = "0123456789abcdef0123456789abcdef"
+
+
+class Tree(object):
+    """
+    Synthetic Time Warp installation in a scratch directory, consisting of a
+    root package database, snapshot and boot environment directories, a boot
+    partition with kernel and initrd images, a state directory and a
+    configuration file.
+    """
+
+    def __init__(
+            self, path: pathlib.Path, database: str = "alpm",
+            loader: str = "systemdboot", packages: int = 50,
+            image_size: int = 8 * 1024 * 1024) -> None:
+        self.path = path
+        self.database = database
+        self.loader = loader
+        self.root = path / "root"
+        self.snapshots = path / "snapshots"
+        self.bootenvs = path / "bootenvs"
+        self.boot = path / "boot"
+        self.state = path / "state"
+        self.version = "5.10.16.arch1-1"
+
+        for directory in [
+                self.root, self.snapshots, self.bootenvs,
+                self.boot / "grub", self.boot / "loader" / "entries",
+                path / "xdg" / "timewarp"]:
+            directory.mkdir(parents=True, exist_ok=True)
+
+        with open(path / "machine-id", "w") as f:
+            f.write(f"{_MACHINE_ID}\n")
+
+        # Kernel and initrd images are filled with random data so that
+        # neither reflinks nor compression make copying unrealistically fast.
+        for name, size in [
+                ("vmlinuz-linux", image_size),
+                ("initramfs-linux.img", image_size * 4),
+                ("intel-ucode.img", image_size // 2)]:
+            with open(self.boot / name, "wb") as f:
+                for _ in range(size // (1024 * 1024)):
+                    f.write(os.urandom(1024 * 1024))
+
+        self._create_database(packages)
+
+        with open(path / "xdg" / "timewarp" / "timewarp.conf", "w") as f:
+            json.dump({
+                "boot": {
+                    "entry": {
+                        "title": "Arch Linux ({linux.version},"
+                        "{snapshot.date},{snapshot.type},"
+                        "{snapshot.description})",
+                        "version": "{linux.version}",
+                        "machine_id": "{machine_id}",
+                        "options": [
+                            {"rootflags": f"subvol={self.bootenvs}/"
+                                "{snapshot.number}"},
+                            "rw"
+                        ],
+                        "architecture": "{architecture}",
+                        "linux": "/{machine_id}/{linux.version}-"
+                        "{architecture}/vmlinuz-linux",
+                        "initrd": [
+                            "/intel-ucode.img",
+                            "/{machine_id}/{linux.version}-{architecture}/"
+                            "initramfs-linux.img"
+                        ]
+                    },
+                    "loader": loader,
+                    "mount_point": str(self.boot)
+                },
+                "bootenv": str(self.bootenvs),
+                "cleanup_delay": 0,
+                "machine_id": str(path / "machine-id"),
+                "package": {
+                    "database": database,
+                    "linux": "linux"
+                },
+                "snapper": {
+                    "cleanup_algorithm": "number",
+                    "description": "timewarp",
+                    "name": "root"
+                },
+                "snapshots": str(self.snapshots),
+                "state": str(self.state)
+            }, f, indent=2)
+
+    def populate(self, count: int) -> typing.Sequence[int]:
+        """
+        Creates snapshots with boot environments and returns their numbers.
+        Boot loader entries and the state index are not touched.
+
+        Keyword arguments:
+        count -- the number of snapshots to create
+        """
+        numbers = []
+
+        for _ in range(count):
+            number = self.create_snapshot()
+            clone(self.snapshots / str(number) / "snapshot",
+                  self.bootenvs / str(number))
+            numbers.append(number)
+
+        return numbers
+
+    def create_snapshot(self) -> int:
+        """Creates a snapshot of the root directory, returning its number."""
+        numbers = [
+            int(snapshot.name) for snapshot in self.snapshots.glob("*")
+            if snapshot.name.isdigit()]
+        number = max(numbers, default=0) + 1
+        (self.snapshots / str(number)).mkdir()
+        clone(self.root, self.snapshots / str(number) / "snapshot")
+        return number
+
+    def configuration(self) -> timewarp.configuration.Configuration:
+        """Loads the configuration of the synthetic installation."""
+        xdg_config_dirs = os.environ.get("XDG_CONFIG_DIRS")
+        os.environ["XDG_CONFIG_DIRS"] = str(self.path / "xdg")
+
+        try:
+            return timewarp.configuration.Configuration()
+        finally:
+            if xdg_config_dirs is None:
+                del os.environ["XDG_CONFIG_DIRS"]
+            else:
+                os.environ["XDG_CONFIG_DIRS"] = xdg_config_dirs
+
+    def create_loader(self) -> timewarp.service.boot.Loader:
+        """Creates the boot loader of the synthetic installation."""
+        if "systemdboot" == self.loader:
+            return timewarp.service.boot.loader.systemdboot.SystemDBoot(
+                self.boot)
+
+        return GRUB(self.boot)
+
+    def create_service(
+            self, verify: bool = False) -> timewarp.service.__main__.Service:
+        """
+        Creates a Time Warp service for the synthetic installation without
+        connecting to D-Bus.  Snapper and the Btrfs ioctls are replaced by
+        fakes operating on plain directories.  The boot environments are not
+        reconciled until Service._reconcile is called.
+
+        Keyword arguments:
+        verify -- query the package databases of all boot environments
+                  during reconciliation (default False)
+        """
+        return timewarp.service.__main__.Service(
+            verify, bus=Bus(), configuration=self.configuration(),
+            loader=self.create_loader(), btrfs=Btrfs(), snapper=Snapper(self),
+            root=self.root)
+
+    def _create_database(self, packages: int) -> None:
+        names = [("linux", self.version)] + [
+            (f"package{i}", f"1.{i}-1") for i in range(packages)]
+
+        if "alpm" == self.database:
+            local = self.root / "var" / "lib" / "pacman" / "local"
+
+            for name, version in names:
+                (local / f"{name}-{version}").mkdir(parents=True)
+
+                with open(local / f"{name}-{version}" / "desc", "w") as f:
+                    f.write(
+                        f"%NAME%\n{name}\n\n%VERSION%\n{version}\n\n"
+                        f"%DESC%\nSynthetic package {name}\n\n"
+                        f"%ARCH%\nx86_64\n\n%BUILDDATE%\n1613000000\n\n"
+                        f"%INSTALLDATE%\n1613000000\n\n%SIZE%\n1048576\n\n"
+                        f"%LICENSE%\nGPL2\n\n%DEPENDS%\nglibc\n\n")
+        else:
+            path = self.root / "var" / "lib" / "dpkg"
+            path.mkdir(parents=True)
+
+            with open(path / "status", "w") as f:
+                for name, version in names:
+                    f.write(
+                        f"Package: {name}\n"
+                        f"Status: install ok installed\n"
+                        f"Priority: optional\n"
+                        f"Section: misc\n"
+                        f"Installed-Size: 1024\n"
+                        f"Maintainer: Time Warp <timewarp@example.com>\n"
+                        f"Architecture: amd64\n"
+                        f"Version: {version}\n"
+                        f"Description: Synthetic package {name}\n\n")
+
+
+class Bus(object):
+    """Fake D-Bus bus on which no other service is running."""
+
+    def get(self, bus_name: str, object_path: str = None) -> typing.Any:
+        raise GLib.Error(f"The name {bus_name} is not owned")
+
+    def publish(self, bus_name: str, *objects: typing.Any) -> None:
+        pass
+
+
+class GRUB(timewarp.service.boot.loader.grub.GRUB):
+    """GRUB boot loader on a boot partition without a block device."""
+
+    def _probe(self, mount_point: pathlib.Path, boot_on_root: bool) -> None:
+        # GRUB inspects the boot partition block device which does not exist
+        # here, so the device dependent attributes are set directly.
+        self._root_file_system = timewarp.namespace.Namespace(
+            uuid="00000000-0000-0000-0000-000000000000")
+        self._boot_file_system = self._root_file_system
+        self._root = "hd0,gpt1"
+        self._baremetal_root = "ahci0,gpt1"
+        self._modules = ["gzio", "part_gpt", "fat"]
+
+
+class Snapper(object):
+    """Fake Snapper creating snapshots as copies of the root directory."""
+
+    def __init__(self, tree: Tree) -> None:
+        self._tree = tree
+        self._pre_numbers = {}
+        self._snapshots = {}
+
+    def create_pre_snapshot(
+            self, description: str, userdata: typing.Mapping[str, str],
+            session: str = "") -> timewarp.service.snapper.Snapshot:
+        if session not in self._pre_numbers:
+            self._pre_numbers[session] = self._tree.create_snapshot()
+
+        return self._get_snapshot(
+            self._pre_numbers[session],
+            timewarp.service.snapper.SnapshotType.PRE, 0, description,
+            userdata)
+
+    def create_post_snapshot(
+            self, description: str, userdata: typing.Mapping[str, str],
+            session: str = "") -> timewarp.service.snapper.Snapshot:
+        if session not in self._pre_numbers:
+            raise timewarp.error.NoPreSnapshotError
+
+        pre_number = self._pre_numbers.pop(session)
+        return self._get_snapshot(
+            self._tree.create_snapshot(),
+            timewarp.service.snapper.SnapshotType.POST, pre_number,
+            description, userdata)
+
+    def create_single_snapshot(
+            self, description: str,
+            userdata: typing.Mapping[str, str]) -> \
+            timewarp.service.snapper.Snapshot:
+        return self._get_snapshot(
+            self._tree.create_snapshot(),
+            timewarp.service.snapper.SnapshotType.SINGLE, 0, description,
+            userdata)
+
+    def get_snapshot(self, number: int) -> timewarp.service.snapper.Snapshot:
+        # Snapshots created by Tree.populate are single snapshots.
+        if number not in self._snapshots:
+            self._get_snapshot(
+                number, timewarp.service.snapper.SnapshotType.SINGLE, 0,
+                "timewarp", {})
+
+        return self._snapshots[number]
+
+    def _get_snapshot(
+            self, number: int, type: timewarp.service.snapper.SnapshotType,
+            pre_number: int, description: str,
+            userdata: typing.Mapping[str, str]) -> \
+            timewarp.service.snapper.Snapshot:
+        self._snapshots[number] = timewarp.service.snapper.Snapshot(
+            number, type.value, pre_number, int(time.time()), 0, description,
+            "number", userdata)
+        return self._snapshots[number]
+
+
+class Btrfs(object):
+    """Fake Btrfs subvolume operations on plain directories."""
+
+    def snapshot(
+            self, source: pathlib.Path, destination: pathlib.Path) -> None:
+        clone(source, destination)
+
+    def delete(
+            self, paths: typing.Iterable[pathlib.Path],
+            commit: bool = False) -> None:
+        for path in paths:
+            shutil.rmtree(path)
+
+    def get_subvolume_info(
+            self, path: pathlib.Path) -> timewarp.namespace.Namespace:
+        # Directories have neither a UUID nor a generation, the inode number
+        # and the modification time of the package database stand in for
+        # them.
+        try:
+            stat = os.stat(path)
+            database = max(
+                os.stat(path / name).st_mtime_ns
+                for name in ["var/lib/pacman/local", "var/lib/dpkg"]
+                if (path / name).exists())
+        except (OSError, ValueError) as e:
+            raise timewarp.error.SubvolumeError(str(e))
+
+        return timewarp.namespace.Namespace(
+            uuid=f"{stat.st_dev}:{stat.st_ino}", generation=database)
+
+    def sync(self, path: pathlib.Path, wait: bool = True) -> None:
+        pass
+
+
+def clone(source: pathlib.Path, destination: pathlib.Path) -> None:
+    """
+    Copies a directory tree using hard links, which is about as cheap as a
+    Btrfs snapshot.
+
+    Keyword arguments:
+    source      -- the source directory
+    destination -- the destination directory
+    """
+    shutil.copytree(source, destination, symlinks=True, copy_function=os.link)
@@ -37,13 +37,18 @@ class Client(object):
             if "important" in self._configuration.package else set()
 
     @argh.arg("-t", "--type", choices=["pre", "post", "single"], required=True)
-    def create(self, type: str = None) -> None:
+    def create(self, type: str = None, session: str = None) -> None:
         """
         Creates a new pre-, post- or single snapshot.
 
         Keyword arguments:
-        type -- "pre", "post" or "single" depending on the snapshot type
+        type    -- "pre", "post" or "single" depending on the snapshot type
+        session -- the session token pairing pre- and post-snapshots
+                   (default: the TIMEWARP_SESSION environment variable)
         """
+        if session is None:
+            session = os.environ.get("TIMEWARP_SESSION")
+
         if type in ["pre", "single"]:
             packages = set()
 
@@ -57,11 +62,17 @@ class Client(object):
                 packages |= set(re.split(r"\s", buffer))
 
             if "pre" == type:
-                number = self._service.CreatePreSnapshot(
-                    packages & self._important)
+                if session is not None:
+                    number = self._service.CreateSessionPreSnapshot(
+                        session, packages & self._important)
+                else:
+                    number = self._service.CreatePreSnapshot(
+                        packages & self._important)
             else:
                 number = self._service.CreateSingleSnapshot(
                     packages & self._important)
+        elif session is not None:
+            number = self._service.CreateSessionPostSnapshot(session)
         else:
             number = self._service.CreatePostSnapshot()
 
@@ -69,6 +80,23 @@ class Client(object):
             print("Operation failed. Check the syslog for details.")
             exit(-1)
 
+    def statistics(self) -> None:
+        """
+        Prints the latency statistics of snapshot creation and clean-up
+        stages.
+        """
+        statistics = self._service.GetStatistics()
+
+        print(
+            f"{'Stage':<16} {'Count':>8} {'Total':>10} {'p50':>10} "
+            f"{'p95':>10} {'p99':>10}")
+
+        for name, (count, total, p50, p95, p99) in sorted(
+                statistics.items()):
+            print(
+                f"{name:<16} {count:>8} {total:>10.3f} {p50:>10.3f} "
+                f"{p95:>10.3f} {p99:>10.3f}")
+
 
 def main(args: typing.List[str] = None) -> None:
     """Entry point."""
@@ -82,7 +110,7 @@ def main(args: typing.List[str] = None) -> None:
 
             # Process command line arguments.
             parser = argh.ArghParser(prog="timewarp")
-            parser.add_commands([client.create])
+            parser.add_commands([client.create, client.statistics])
             parser.dispatch()
         except timewarp.error.InitializationError as e:
             print(f"Failed to start timewarp: {e.message}.")
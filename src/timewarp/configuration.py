@@ -93,17 +93,27 @@ class Configuration(object):
                             }
                         }
                     },
+                    "lazy": {
+                        "type": "boolean"
+                    },
                     "loader": {
                         "type": "string"
                     },
                     "mount_point": {
                         "type": "string"
+                    },
+                    "store": {
+                        "type": "boolean"
                     }
                 }
             },
             "bootenv": {
                 "type": "string"
             },
+            "cleanup_delay": {
+                "type": "integer",
+                "minimum": 0
+            },
             "machine_id": {
                 "type": "string"
             },
@@ -150,8 +160,32 @@ class Configuration(object):
                     }
                 }
             },
+            "retention": {
+                "type": "object",
+                "additionalProperties": False,
+                "properties": {
+                    "important": {
+                        "type": "boolean"
+                    },
+                    "last": {
+                        "type": "integer",
+                        "minimum": 0
+                    },
+                    "last_per_kernel": {
+                        "type": "integer",
+                        "minimum": 0
+                    }
+                }
+            },
             "snapshots": {
                 "type": "string"
+            },
+            "state": {
+                "type": "string"
+            },
+            "workers": {
+                "type": "integer",
+                "minimum": 1
             }
         }
     }
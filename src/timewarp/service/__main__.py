@@ -4,24 +4,38 @@
 # All rights reserved.
 #
 
+import argh
+import concurrent.futures
 import enum
 import functools
 from gi.repository import Gio, GLib
 import importlib
+import os
 import pathlib
 import platform
 import pydbus
-import sh
-import shutil
+import pydbus.generic
 import signal
 import sys
 import syslog
+import threading
 import typing
 
 import timewarp.configuration
 import timewarp.error
+import timewarp.namespace
 import timewarp.service.block
+import timewarp.service.boot
+import timewarp.service.btrfs
+import timewarp.service.copier
+import timewarp.service.job
+import timewarp.service.journal
+import timewarp.service.metrics
+import timewarp.service.package
+import timewarp.service.retention
 import timewarp.service.snapper
+import timewarp.service.state
+import timewarp.service.store
 
 
 class Architecture(enum.Enum):
@@ -50,18 +64,105 @@ class Service(object):
                 <arg type="b" name="important" direction="in"/>
                 <arg type="u" name="number" direction="out"/>
             </method>
+            <method name="CreateSessionPreSnapshot">
+                <arg type="s" name="session" direction="in"/>
+                <arg type="b" name="important" direction="in"/>
+                <arg type="u" name="number" direction="out"/>
+            </method>
+            <method name="CreateSessionPostSnapshot">
+                <arg type="s" name="session" direction="in"/>
+                <arg type="u" name="number" direction="out"/>
+            </method>
+            <method name="StartCreatePreSnapshot">
+                <arg type="b" name="important" direction="in"/>
+                <arg type="s" name="job" direction="out"/>
+            </method>
+            <method name="StartCreatePostSnapshot">
+                <arg type="s" name="job" direction="out"/>
+            </method>
+            <method name="StartCreateSingleSnapshot">
+                <arg type="b" name="important" direction="in"/>
+                <arg type="s" name="job" direction="out"/>
+            </method>
+            <method name="StartCreateSessionPreSnapshot">
+                <arg type="s" name="session" direction="in"/>
+                <arg type="b" name="important" direction="in"/>
+                <arg type="s" name="job" direction="out"/>
+            </method>
+            <method name="StartCreateSessionPostSnapshot">
+                <arg type="s" name="session" direction="in"/>
+                <arg type="s" name="job" direction="out"/>
+            </method>
+            <method name="GetJob">
+                <arg type="s" name="job" direction="in"/>
+                <arg type="s" name="state" direction="out"/>
+                <arg type="d" name="progress" direction="out"/>
+                <arg type="s" name="stage" direction="out"/>
+                <arg type="u" name="number" direction="out"/>
+            </method>
+            <method name="CancelJob">
+                <arg type="s" name="job" direction="in"/>
+                <arg type="b" name="cancelled" direction="out"/>
+            </method>
+            <method name="CreateBootEnvironments">
+                <arg type="au" name="numbers" direction="in"/>
+                <arg type="a(ubs)" name="results" direction="out"/>
+            </method>
+            <method name="DeleteBootEnvironments">
+                <arg type="au" name="numbers" direction="in"/>
+                <arg type="a(ubs)" name="results" direction="out"/>
+            </method>
+            <method name="Materialize">
+                <arg type="au" name="numbers" direction="in"/>
+                <arg type="a(ubs)" name="results" direction="out"/>
+            </method>
+            <method name="Prune">
+                <arg type="a(ubs)" name="results" direction="out"/>
+            </method>
+            <method name="GetStatistics">
+                <arg type="a{s(tdddd)}" name="statistics" direction="out"/>
+            </method>
+            <signal name="JobProgress">
+                <arg type="s" name="job"/>
+                <arg type="d" name="progress"/>
+                <arg type="s" name="stage"/>
+            </signal>
+            <signal name="JobCompleted">
+                <arg type="s" name="job"/>
+                <arg type="s" name="state"/>
+                <arg type="u" name="number"/>
+            </signal>
         </interface>
     </node>
     """
 
     """Time Warp service."""
 
-    def __init__(self) -> None:
-        system_bus = pydbus.SystemBus()
+    JobProgress = pydbus.generic.signal()
+    JobCompleted = pydbus.generic.signal()
+
+    def __init__(
+            self, verify: bool = False, session_bus: bool = False,
+            bus: typing.Any = None,
+            configuration: timewarp.configuration.Configuration = None,
+            loader: timewarp.service.boot.Loader = None,
+            btrfs: timewarp.service.btrfs.Btrfs = None,
+            snapper: timewarp.service.snapper.Snapper = None,
+            root: pathlib.Path = pathlib.Path("/")) -> None:
+        # The D-Bus bus, the configuration, the boot loader, the Btrfs
+        # subvolume operations and Snapper are only created here if they have
+        # not been passed, e.g. by the benchmark harness, see
+        # benchmarks/tree.py.  The package databases are looked up relative to
+        # root.  The session bus is used for testing against a local snapperd
+        # stand-in, see benchmarks/snapperd.py.
+        bus_name = "session" if session_bus else "system"
+
+        if bus is None:
+            bus = pydbus.SessionBus() if session_bus else pydbus.SystemBus()
 
         # Check if timewarpd is already running.
         try:
-            system_bus.get("com.branchonequal.TimeWarp")
+            bus.get("com.branchonequal.TimeWarp")
             running = True
         except GLib.Error:
             running = False
@@ -71,43 +172,70 @@ class Service(object):
                 "timewarpd is already running")
 
         self._in_init = True
+        self._lock = threading.RLock()
+        self._index_lock = threading.Lock()
+        self._loader_lock = threading.Lock()
+        self._reconciled = threading.Event()
+        self._metrics = timewarp.service.metrics.Metrics()
+
+        # Session token: pre-snapshot userdata mapping, the post-snapshot
+        # inherits the userdata of the pre-snapshot of the same session.
         self._userdata = {}
 
-        # Set up a signal handler to cleanly quit the main event loop on
-        # Ctrl+C and SIGTERM.
-        signal.signal(signal.SIGINT, self._signal_handler)
-        signal.signal(signal.SIGTERM, self._signal_handler)
-
         # Set up the main event loop.
         self._loop = GLib.MainLoop()
 
         # Load the configuration.  Raises InitializationError if the
         # configuration file could not be found or the configuration is
         # invalid.
-        self._configuration = timewarp.configuration.Configuration()
+        self._configuration = configuration \
+            if configuration is not None \
+            else timewarp.configuration.Configuration()
 
         self._bootenvs = pathlib.Path(self._configuration.bootenv)
         self._linux = self._configuration.package.linux
         self._mount_point = pathlib.Path(self._configuration.boot.mount_point)
         self._snapshots = pathlib.Path(self._configuration.snapshots)
+        self._cleanup_delay = self._configuration.cleanup_delay \
+            if self._configuration.cleanup_delay is not None else 1000
+        self._pending = set()
+        self._pending_source = 0
+        self._workers = self._configuration.workers \
+            if self._configuration.workers is not None \
+            else min(32, (os.cpu_count() or 1) + 4)
+
+        # Boot environments are pruned according to the retention policy
+        # after each snapshot creation.  Pruning is disabled by default.
+        retention = self._configuration.retention \
+            if self._configuration.retention is not None \
+            else timewarp.namespace.Namespace()
+        self._retention = timewarp.service.retention.Policy(
+            retention.last, retention.last_per_kernel,
+            retention.important if retention.important is not None else True)
 
         boot_on_root = self._configuration.boot.boot_on_root \
             if "boot_on_root" in self._configuration.boot else False
+
+        # In lazy mode, boot environments are only created on demand, either
+        # by the early-boot hook or via the Materialize D-Bus method.
+        self._lazy = self._configuration.boot.lazy \
+            if "lazy" in self._configuration.boot else False
         database = self._configuration.package.database
-        loader = self._configuration.boot.loader
+        loader_name = self._configuration.boot.loader
         machine_id = self._configuration.machine_id
-        snapper = self._configuration.snapper
+        snapper_configuration = self._configuration.snapper
 
         # Import the boot loader module.
         try:
-            importlib.import_module(f"timewarp.service.boot.loader.{loader}")
+            loader_module = importlib.import_module(
+                f"timewarp.service.boot.loader.{loader_name}")
         except ModuleNotFoundError as e:
             raise timewarp.error.InitializationError(
-                f"Boot loader module {loader} not found")
+                f"Boot loader module {loader_name} not found")
 
         # Import the package database module.
         try:
-            importlib.import_module(
+            database_module = importlib.import_module(
                 f"timewarp.service.package.database.{database}")
         except ModuleNotFoundError as e:
             raise timewarp.error.InitializationError(
@@ -125,15 +253,19 @@ class Service(object):
 
         # Initialize the boot loader with the /boot mount point.  Raises
         # InitializationError if a boot loader-specific check has failed.
-        self._loader = timewarp.service.boot.Loader.__subclasses__()[0](
-            self._mount_point, boot_on_root)
+        self._loader = loader if loader is not None else [
+            cls for cls in timewarp.service.boot.Loader.__subclasses__()
+            if cls.__module__ == loader_module.__name__][0](
+                self._mount_point, boot_on_root)
 
         # As we need to be able to access the package databases of boot
         # environments we store the package database class for later use and
         # also initialize the root package database.  Raises
         # InitializationError if the local package database could not be found.
-        self._database = timewarp.service.package.Database.__subclasses__()[0]
-        self._root_database = self._database(pathlib.Path("/"))
+        self._database = [
+            cls for cls in timewarp.service.package.Database.__subclasses__()
+            if cls.__module__ == database_module.__name__][0]
+        self._root_database = self._database(root)
 
         # Check if we can query the kernel package.
         try:
@@ -193,196 +325,639 @@ class Service(object):
             raise timewarp.error.InitializationError(
                 f"Invalid replacement field in boot entry configuration: {e}")
 
-        # Initialize Snapper.  Raises InitializationError if snapperd is not
-        # running.
-        self._snapper = timewarp.service.snapper.Snapper(
-            snapper.name, snapper.cleanup_algorithm)
+        # Kernel and initrd images are optionally kept in a content-addressed
+        # image store on the boot partition.
+        self._copier = timewarp.service.copier.Copier()
+        self._store = timewarp.service.store.Store(
+            self._mount_point / "timewarp", self._copier) \
+            if self._configuration.boot.store else None
 
-        # Clean up orphaned boot environments.
-        bootenvs = set([file.name for file in self._bootenvs.glob("*")])
-        snapshots = set([file.name for file in self._snapshots.glob("*")])
+        # Boot environments are created and deleted using the Btrfs ioctls.
+        self._btrfs = btrfs if btrfs is not None \
+            else timewarp.service.btrfs.Btrfs()
 
-        for bootenv in bootenvs - snapshots:
-            try:
-                self._clean_up(int(bootenv), True)
-            except ValueError:
-                pass
-
-        # Publish the service on the D-Bus system bus.
+        # Initialize Snapper.  Raises InitializationError if snapperd is not
+        # running.
+        self._snapper = snapper if snapper is not None \
+            else timewarp.service.snapper.Snapper(
+                snapper_configuration.name,
+                snapper_configuration.cleanup_algorithm, bus)
+
+        state = pathlib.Path(
+            self._configuration.state
+            if self._configuration.state is not None
+            else "/var/lib/timewarp")
+
+        # Open the persistent state index and the intent journal.  Raises
+        # InitializationError if the state database could not be opened or
+        # the journal is invalid.
+        self._state = timewarp.service.state.State(state)
+        self._journal = timewarp.service.journal.Journal(state / "journal")
+
+        # A newly created state index has to be filled from the package
+        # databases of all boot environments.
+        self._verify = verify or self._state.created
+
+        # The kernel version: boot environment reference count index is built
+        # in the background, see _reconcile.
+        self._bootenv_kernels = {}
+        self._kernels = {}
+
+        # Publish the service on the D-Bus bus.
         try:
-            system_bus.publish("com.branchonequal.TimeWarp", self)
+            bus.publish("com.branchonequal.TimeWarp", self)
         except GLib.Error as e:
             raise timewarp.error.InitializationError(
-                f"Connection to the D-Bus system bus failed: "
+                f"Connection to the D-Bus {bus_name} bus failed: "
                 f"{timewarp.error.DBusError(e.code)}")
 
         # Set syslog logging options.
         syslog.openlog("timewarpd")
-        self._in_init = False
+
+        # Long-running snapshot creation jobs are run on a worker thread so
+        # that the main event loop is not blocked.
+        self._jobs = timewarp.service.job.JobQueue(
+            lambda job: GLib.idle_add(
+                self._emit_job_progress, job.id, job.progress, job.stage),
+            lambda job: GLib.idle_add(
+                self._emit_job_completed, job.id, str(job.state), job.number))
 
     def CreatePreSnapshot(self, important: bool) -> int:
         """Creates a new pre-snapshot, returning the snapshot number."""
-        self._userdata = {"important": "yes"} if important else {}
-        return self._create_snapshot(timewarp.service.snapper.SnapshotType.PRE)
+        return self.CreateSessionPreSnapshot("", important)
 
     def CreatePostSnapshot(self) -> int:
         """Creates a new post-snapshot, returning the snapshot number."""
-        return self._create_snapshot(
-            timewarp.service.snapper.SnapshotType.POST)
+        return self.CreateSessionPostSnapshot("")
 
     def CreateSingleSnapshot(self, important: bool) -> int:
         """Creates a new single snapshot, returning the snapshot number."""
-        self._userdata = {"important": "yes"} if important else {}
         return self._create_snapshot(
-            timewarp.service.snapper.SnapshotType.SINGLE)
+            timewarp.service.snapper.SnapshotType.SINGLE,
+            {"important": "yes"} if important else {})
+
+    def CreateSessionPreSnapshot(self, session: str, important: bool) -> int:
+        """
+        Creates a new pre-snapshot for a session, returning the snapshot
+        number.  Sessions pair pre- and post-snapshots independently of each
+        other.
+        """
+        self._userdata[session] = {"important": "yes"} if important else {}
+        return self._create_snapshot(
+            timewarp.service.snapper.SnapshotType.PRE,
+            self._userdata[session], session)
+
+    def CreateSessionPostSnapshot(self, session: str) -> int:
+        """
+        Creates a new post-snapshot for a session, returning the snapshot
+        number.
+        """
+        return self._create_snapshot(
+            timewarp.service.snapper.SnapshotType.POST,
+            self._userdata.pop(session, {}), session)
+
+    def StartCreatePreSnapshot(self, important: bool) -> str:
+        """
+        Starts creating a new pre-snapshot in the background, returning the
+        job ID.
+        """
+        return self.StartCreateSessionPreSnapshot("", important)
+
+    def StartCreatePostSnapshot(self) -> str:
+        """
+        Starts creating a new post-snapshot in the background, returning the
+        job ID.
+        """
+        return self.StartCreateSessionPostSnapshot("")
+
+    def StartCreateSingleSnapshot(self, important: bool) -> str:
+        """
+        Starts creating a new single snapshot in the background, returning
+        the job ID.
+        """
+        return self._jobs.submit(
+            self._create_snapshot,
+            timewarp.service.snapper.SnapshotType.SINGLE,
+            {"important": "yes"} if important else {}).id
+
+    def StartCreateSessionPreSnapshot(
+            self, session: str, important: bool) -> str:
+        """
+        Starts creating a new pre-snapshot for a session in the background,
+        returning the job ID.
+        """
+        self._userdata[session] = {"important": "yes"} if important else {}
+        return self._jobs.submit(
+            self._create_snapshot, timewarp.service.snapper.SnapshotType.PRE,
+            self._userdata[session], session).id
+
+    def StartCreateSessionPostSnapshot(self, session: str) -> str:
+        """
+        Starts creating a new post-snapshot for a session in the background,
+        returning the job ID.
+        """
+        return self._jobs.submit(
+            self._create_snapshot, timewarp.service.snapper.SnapshotType.POST,
+            self._userdata.pop(session, {}), session).id
+
+    def GetJob(self, id: str) -> typing.Tuple[str, float, str, int]:
+        """
+        Returns the state, progress, current stage and snapshot number of a
+        job.  The state is "unknown" if there is no such job.
+        """
+        job = self._jobs.get(id)
+
+        if job is None:
+            return "unknown", 0.0, "", 0
+
+        return str(job.state), job.progress, job.stage, job.number
+
+    def CancelJob(self, id: str) -> bool:
+        """Cancels a pending job, returning True on success."""
+        return self._jobs.cancel(id)
+
+    def CreateBootEnvironments(
+            self, numbers: typing.List[int]) -> \
+            typing.List[typing.Tuple[int, bool, str]]:
+        """
+        Creates boot environments for existing snapshots in one batch,
+        returning the snapshot number, success and error message of each.
+        """
+        # The index is only complete once the boot environments have been
+        # reconciled.
+        self._reconciled.wait()
+
+        with self._lock:
+            errors = self._create_boot_environments(numbers)
+
+        return [
+            (number, errors[number] is None, errors[number] or "")
+            for number in numbers]
+
+    def DeleteBootEnvironments(
+            self, numbers: typing.List[int]) -> \
+            typing.List[typing.Tuple[int, bool, str]]:
+        """
+        Deletes boot environments in one batch, keeping the snapshots, and
+        returns the snapshot number, success and error message of each.
+        """
+        # Kernel and initrd images would be deleted while other boot
+        # environments are still using them unless the kernel version index
+        # is complete.
+        self._reconciled.wait()
+
+        file_system = timewarp.service.block.FileSystem("/")
+        errors = {}
+
+        for number in numbers:
+            bootenv = self._bootenvs / str(number)
+
+            if not self._is_boot_environment(number):
+                errors[number] = \
+                    f"Boot environment {bootenv} does not exist"
+            elif bootenv == file_system.subvol:
+                errors[number] = f"Failed to delete boot environment " \
+                    f"{bootenv}: Boot environment in use"
+
+        with self._lock, concurrent.futures.ThreadPoolExecutor(
+                self._workers) as executor:
+            errors.update(self._clean_up(
+                [number for number in numbers if number not in errors],
+                executor))
+
+        return [
+            (number, errors[number] is None, errors[number] or "")
+            for number in numbers]
+
+    def Materialize(
+            self, numbers: typing.List[int]) -> \
+            typing.List[typing.Tuple[int, bool, str]]:
+        """
+        Creates the deferred boot environments of existing boot loader
+        entries, returning the snapshot number, success and error message of
+        each.
+        """
+        # Deferred boot environments are only known once the boot
+        # environments have been reconciled.
+        self._reconciled.wait()
+
+        with self._lock:
+            errors = {
+                number: self._materialize(number)
+                for number in sorted(set(numbers))}
+
+        return [
+            (number, errors[number] is None, errors[number] or "")
+            for number in numbers]
+
+    def Prune(self) -> typing.List[typing.Tuple[int, bool, str]]:
+        """
+        Prunes boot environments according to the retention policy, returning
+        the snapshot number, success and error message of each pruned boot
+        environment.
+        """
+        # Pruning deletes kernel and initrd images which are not in use
+        # according to the kernel version index, which is only complete once
+        # the boot environments have been reconciled.
+        self._reconciled.wait()
+
+        errors = self._prune()
+
+        return [
+            (number, error is None, error or "")
+            for number, error in sorted(errors.items())]
+
+    def GetStatistics(self) -> typing.Mapping[
+            str, typing.Tuple[int, float, float, float, float]]:
+        """
+        Returns the count, total, median, 95th and 99th percentile latency in
+        seconds of each snapshot creation and clean-up stage.
+        """
+        return self._metrics.get()
 
     def start(self) -> None:
-        """Starts the main event loop."""
+        """
+        Starts reconciling the boot environments with the snapshots and the
+        main event loop.
+        """
+        # Set up a signal handler to cleanly quit the main event loop on
+        # Ctrl+C and SIGTERM.
+        signal.signal(signal.SIGINT, self._signal_handler)
+        signal.signal(signal.SIGTERM, self._signal_handler)
+
+        # Reconcile the boot environments with the snapshots in the
+        # background.  The service has already been published at this point
+        # so that clients do not have to wait.
+        threading.Thread(target=self._reconcile, daemon=True).start()
+
         self._loop.run()
 
+    def _add_to_index(
+            self, number: int,
+            package: typing.Optional[timewarp.service.package.Package]) -> \
+            None:
+        version = package.version if package is not None else None
+
+        with self._index_lock:
+            self._bootenv_kernels[number] = package
+            self._kernels.setdefault(version, set()).add(number)
+
+    def _remove_from_index(self, number: int) -> None:
+        with self._index_lock:
+            package = self._bootenv_kernels.pop(number, None)
+            version = package.version if package is not None else None
+            numbers = self._kernels.get(version, set())
+            numbers.discard(number)
+
+            if not numbers:
+                self._kernels.pop(version, None)
+
+    def _is_boot_environment(self, number: int) -> bool:
+        # Deferred boot environments only exist in the index until they are
+        # materialized.
+        with self._index_lock:
+            return number in self._bootenv_kernels or \
+                (self._bootenvs / str(number)).exists()
+
+    def _is_kernel_in_use(self, version: str) -> bool:
+        # Boot environments with an unknown kernel version might be using any
+        # kernel so we have to assume that the kernel is still in use.
+        with self._index_lock:
+            return version in self._kernels or None in self._kernels
+
+    def _get_kernel(
+            self, number: int,
+            path: pathlib.Path) -> timewarp.service.package.Package:
+        # The package database of a subvolume is only read if the subvolume
+        # has been modified since the kernel package has been cached.
+        try:
+            info = self._btrfs.get_subvolume_info(path)
+        except timewarp.error.SubvolumeError:
+            info = None
+
+        if info is not None:
+            package = self._state.get_package(
+                info.uuid, info.generation, self._linux)
+
+            if package is not None:
+                return package
+
+        package = self._database(path).get_packages_by_name(self._linux)[-1]
+
+        if info is not None:
+            self._state.set_package(
+                info.uuid, number, info.generation, self._linux, package)
+
+        return package
+
+    def _query_kernel(
+            self, number: int) -> \
+            typing.Optional[timewarp.service.package.Package]:
+        try:
+            return self._get_kernel(number, self._get_source(number))
+        except (timewarp.error.InitializationError,
+                timewarp.error.InvalidPackageInformationError,
+                timewarp.error.PackageNotFoundError):
+            # The kernel version of this boot environment is unknown.  It is
+            # indexed under None so that no kernel or initrd images will be
+            # removed as long as the boot environment exists.
+            return None
+
+    def _reconcile(self) -> None:
+        try:
+            self._reconcile_boot_environments()
+        except Exception as e:
+            syslog.syslog(
+                syslog.LOG_ERR, f"Failed to reconcile boot environments: "
+                f"Unexpected error: {e}")
+        finally:
+            # Even if reconciliation has failed, snapshot deletions must not
+            # be postponed forever.
+            self._in_init = False
+            self._reconciled.set()
+
+            # Clean up after the snapshots which have been deleted during
+            # reconciliation, see _clean_up_pending.
+            GLib.idle_add(self._clean_up_pending)
+
+    def _reconcile_boot_environments(self) -> None:
+        # Resume boot environment creations which have been interrupted
+        # first, so that their boot environments are not mistaken for
+        # orphans.
+        for number, operation in self._journal.pending().items():
+            self._resume(number, operation)
+
+        # Read the state index before listing the boot environment directory
+        # so that boot environments created in the meantime are not mistaken
+        # for deleted ones.  Boot environments which are in the state index
+        # but not in the boot environment directory are deferred, see
+        # _materialize.
+        bootenvs = self._state.get_boot_environments()
+        existing = set(
+            int(bootenv.name) for bootenv in self._bootenvs.glob("*")
+            if bootenv.name.isdigit())
+        numbers = sorted(set(bootenvs).union(existing))
+        snapshots = set([file.name for file in self._snapshots.glob("*")])
+        failed = []
+
+        # Without lazy mode there are no deferred boot environments, so in
+        # verify mode the missing boot environments of existing snapshots are
+        # recreated.  Those which cannot be recreated are cleaned up along
+        # with their boot loader entries.
+        if self._verify and not self._lazy:
+            for number in sorted(set(bootenvs) - existing):
+                if str(number) not in snapshots:
+                    continue
+
+                bootenv = self._bootenvs / str(number)
+
+                try:
+                    self._btrfs.snapshot(
+                        self._snapshots / str(number) / "snapshot", bootenv)
+                except timewarp.error.SubvolumeError as e:
+                    syslog.syslog(
+                        syslog.LOG_ERR, f"Failed to create boot environment "
+                        f"{bootenv}: {e.message}")
+                    failed.append(number)
+
+        # Only query the package databases of boot environments which are
+        # not in the state index yet or whose kernel is unknown.  In verify
+        # mode, all package databases are queried to repair the state index.
+        unknown = [
+            number for number in numbers
+            if self._verify or bootenvs.get(number) is None]
+
+        with concurrent.futures.ThreadPoolExecutor(self._workers) as executor:
+            for number, package in zip(
+                    unknown, executor.map(self._query_kernel, unknown)):
+                self._state.set_kernel(
+                    number, self._bootenvs / str(number), package)
+                bootenvs[number] = package
+
+            # Build the kernel version: boot environment reference count
+            # index.  Afterwards the index is kept up to date on snapshot
+            # creation and clean-up.
+            for number in numbers:
+                self._add_to_index(number, bootenvs[number])
+
+            # Clean up orphaned boot environments.
+            self._clean_up(
+                [number for number in numbers
+                    if str(number) not in snapshots] + failed, executor)
+
+        # From now on, errors during clean-up are logged.
+        self._in_init = False
+        self._prune()
+
     def _clean_up_error_handler(
-            function: typing.Callable[..., None]) -> \
-            typing.Callable[..., None]:
+            function: typing.Callable[..., typing.Any]) -> \
+            typing.Callable[
+                ..., typing.Tuple[typing.Any, typing.Optional[str]]]:
         @functools.wraps(function)
         def decorator(
                 self, *args: typing.Iterable[typing.Any],
-                **kwargs: typing.Iterable[typing.Any]) -> None:
+                **kwargs: typing.Iterable[typing.Any]) -> \
+                typing.Tuple[typing.Any, typing.Optional[str]]:
             bootenv = self._bootenvs / str(args[0])
 
+            # Returns the result and None on success or None and the error
+            # message on error.
             try:
-                function(self, *args, **kwargs)
+                return function(self, *args, **kwargs), None
             except timewarp.error.InitializationError as e:
-                if not self._in_init:
-                    syslog.syslog(
-                        syslog.LOG_ERR, f"Failed to initialize package "
-                        f"database of boot environment {bootenv}: {e.message}")
+                message = f"Failed to initialize package database of boot " \
+                    f"environment {bootenv}: {e.message}"
             except timewarp.error.InvalidPackageInformationError:
-                if not self._in_init:
-                    syslog.syslog(
-                        syslog.LOG_ERR, f"Failed to query package database of "
-                        f"boot environment {bootenv}: Package information for "
-                        f"kernel package {self._linux} is invalid")
+                message = f"Failed to query package database of boot " \
+                    f"environment {bootenv}: Package information for kernel " \
+                    f"package {self._linux} is invalid"
             except timewarp.error.PackageNotFoundError:
-                if not self._in_init:
-                    syslog.syslog(
-                        syslog.LOG_ERR, f"Failed to query package database of "
-                        f"boot environment {bootenv}: Kernel package "
-                        f"{self._linux} not found")
+                message = f"Failed to query package database of boot " \
+                    f"environment {bootenv}: Kernel package {self._linux} " \
+                    f"not found"
             except timewarp.error.SubvolumeError as e:
-                if not self._in_init:
-                    syslog.syslog(syslog.LOG_ERR, e.message)
+                message = e.message
             except Exception as e:
                 syslog.syslog(syslog.LOG_ERR, f"Unexpected error: {e}")
+                return None, f"Unexpected error: {e}"
+
+            if not self._in_init:
+                syslog.syslog(syslog.LOG_ERR, message)
+
+            return None, message
 
         return decorator
 
-    @_clean_up_error_handler
-    def _clean_up(self, number: int, quiet: bool = False) -> None:
-        bootenv = self._bootenvs / str(number)
+    def _clean_up(
+            self, numbers: typing.Iterable[int],
+            executor: concurrent.futures.Executor = None) -> \
+            typing.Mapping[int, typing.Optional[str]]:
+        # Returns a snapshot number: error message mapping, the error message
+        # is None if the boot environment has been deleted.
+        numbers = sorted(set(numbers))
+
+        if not numbers:
+            return {}
+
+        with self._metrics.measure("cleanup"):
+            return self._clean_up_measured(numbers, executor)
+
+    def _clean_up_measured(
+            self, numbers: typing.Sequence[int],
+            executor: typing.Optional[concurrent.futures.Executor]) -> \
+            typing.Mapping[int, typing.Optional[str]]:
+        # Remove all boot loader entries at once in a single transaction.  If
+        # this fails we are not deleting any boot environment as the remaining
+        # entries would point to non-existing boot environments.
+        try:
+            with self._loader_lock, \
+                    self._metrics.measure("cleanup.entries"), \
+                    self._loader.transaction():
+                self._loader.remove_entries(numbers)
+        except Exception as e:
+            syslog.syslog(syslog.LOG_ERR, f"Unexpected error: {e}")
+            return {number: f"Unexpected error: {e}" for number in numbers}
+
         file_system = timewarp.service.block.FileSystem("/")
+        errors = {}
+        packages = {}
+
+        # The kernel and initrd images recorded in the state index have to be
+        # looked up before the boot environments are removed from it.
+        files = {number: self._state.get_files(number) for number in numbers}
+        recorded = {}
+        unrecorded = set()
+
+        # Each boot environment is deleted independently so this can be done
+        # in parallel if an executor has been passed.
+        for number, (package, error) in zip(numbers, (
+                executor.map if executor is not None else map)(
+                    lambda number: self._delete_boot_environment(
+                        number, file_system), numbers)):
+            errors[number] = error
+
+            # Images in the image store are reference counted by snapshot
+            # number rather than by kernel version.  The references are only
+            # released once the boot environment is gone, i.e. neither if
+            # deleting it has failed nor if it is in use.
+            if self._store is not None and error is None and \
+                    not (self._bootenvs / str(number)).exists() and \
+                    self._store.release(number):
+                continue
+
+            if package is not None:
+                packages[package.version] = package
+
+                if files[number]:
+                    recorded.setdefault(package.version, set()).update(
+                        files[number])
+                else:
+                    unrecorded.add(package.version)
+
+        # Now that all boot environments have been deleted, remove the kernel
+        # and initrd images of all kernel versions which are not used by any
+        # of the remaining boot environments.  Snapshot creation might copy
+        # the same images in the meantime so we are holding the lock.
+        with self._lock, self._metrics.measure("cleanup.images"):
+            for version, package in packages.items():
+                if self._is_kernel_in_use(version):
+                    continue
 
-        # Remove the boot loader entry.
-        self._loader.remove_entry(number)
+                # The images of boot environments created by earlier versions
+                # are not recorded and derived from the configuration instead.
+                # Images recorded by any remaining boot environment are kept.
+                candidates = recorded.get(version, set())
 
-        # Initialize the boot environment package database.
-        database = self._database(bootenv)
+                if version in unrecorded:
+                    candidates |= self._get_files(package)
 
-        # Determine which kernel package is installed in the boot environment.
-        package = database.get_packages_by_name(self._linux)[-1]
+                self._remove_files(
+                    candidates - self._state.get_used_files(candidates))
+
+        return errors
+
+    @_clean_up_error_handler
+    def _delete_boot_environment(
+            self, number: int,
+            file_system: timewarp.service.block.FileSystem) -> \
+            typing.Optional[timewarp.service.package.Package]:
+        bootenv = self._bootenvs / str(number)
+
+        # Look up the kernel package installed in the boot environment.  If
+        # the index does not know the kernel version, query the boot
+        # environment package database once more so that errors are reported.
+        package = self._bootenv_kernels.get(number)
+        exists = bootenv.exists()
+
+        if package is None and exists:
+            package = self._get_kernel(number, bootenv)
 
         # Only delete the boot environment if it is currently not mounted on /.
+        # Deferred boot environments only have to be removed from the index.
         if bootenv != file_system.subvol:
             # Delete the boot environment.
             try:
-                sh.btrfs.subvolume.delete(bootenv)
-            except sh.ErrorReturnCode:
+                with self._metrics.measure("cleanup.bootenv"):
+                    if exists:
+                        self._btrfs.delete([bootenv])
+            except timewarp.error.SubvolumeError as e:
                 raise timewarp.error.SubvolumeError(
-                    f"Failed to delete boot environment {bootenv}")
+                    f"Failed to delete boot environment {bootenv}: "
+                    f"{e.message}")
+
+            self._remove_from_index(number)
+            self._state.remove_boot_environments([number])
         else:
             syslog.syslog(
                 syslog.LOG_WARNING, f"Failed to delete boot environment "
                 f"{bootenv}: Boot environment in use")
 
-        remove_files = True
+        return package
 
-        # Now we are iterating over the remaining boot environments and check
-        # if at least one of them is using the same kernel version.
-        for bootenv_ in self._bootenvs.glob("*"):
-            try:
-                database_ = self._database(bootenv_)
-            except timewarp.error.InitializationError as e:
-                if not self._in_init:
-                    syslog.syslog(
-                        syslog.LOG_WARNING, f"Failed to initialize package "
-                        f"database of boot environment {bootenv_}: "
-                        f"{e.message}; not removing kernel or initrd images")
+    def _get_files(
+            self, package: timewarp.service.package.Package) -> \
+            typing.Set[pathlib.Path]:
+        # Extend the default mapping with the kernel package.
+        mapping = {
+            **self._default_mapping,
+            "linux": package
+        }
 
-                # For some reason, the boot environment package database could
-                # not be initialized.  As we cannot make sure that this kernel
-                # version is not needed anymore, we leave it untouched.
-                remove_files = False
-                break
+        return set(self._configuration.filter_files(mapping).values())
 
+    def _remove_files(self, files: typing.Iterable[pathlib.Path]) -> None:
+        # No boot environment is using the kernel anymore so we can safely
+        # remove the kernel and initrd images.
+        paths = set()
+
+        # We are deleting each file individually, keeping track of the
+        # directories to be removed.  We are not just deleting the directories
+        # as they might contain files which we do not want to touch.
+        for file in files:
             try:
-                package_ = database_.get_packages_by_name(self._linux)[-1]
-            except timewarp.error.PackageNotFoundError:
+                file.unlink()
+                paths.add(file.parent)
+            except FileNotFoundError:
                 if not self._in_init:
                     syslog.syslog(
-                        syslog.LOG_WARNING, f"Failed to query package "
-                        f"database of boot environment {bootenv_}: Kernel "
-                        f"package {self._linux} not found; not removing "
-                        f"kernel or initrd images")
+                        syslog.LOG_WARNING, f"Failed to delete {file}: "
+                        f"File not found")
 
-                # Same as the above.
-                remove_files = False
-                break
+        for path in paths:
+            current = path
 
-            if package_.version == package.version:
-                remove_files = False
-                break
-
-        if remove_files:
-            # No other boot environment is using the kernel which was used by
-            # the boot environment we deleted earlier so we can safely remove
-            # the kernel and initrd images.
-
-            # Extend the default mapping with the kernel package.
-            mapping = {
-                **self._default_mapping,
-                "linux": package
-            }
-
-            paths = set()
-
-            # We are deleting each file individually, keeping track of the
-            # directories to be removed.  We are not just deleting the
-            # directories as they might contain files which we do not want to
-            # touch.
-            for file in self._configuration.filter_files(mapping).values():
+            while current != self._mount_point:
                 try:
-                    file.unlink()
-                    paths.add(file.parent)
+                    current.rmdir()
+                    current = current.parent
                 except FileNotFoundError:
                     if not self._in_init:
                         syslog.syslog(
-                            syslog.LOG_WARNING, f"Failed to delete {file}: "
-                            f"File not found")
-
-            for path in paths:
-                current = path
-
-                while current != self._mount_point:
-                    try:
-                        current.rmdir()
-                        current = current.parent
-                    except FileNotFoundError:
-                        if not self._in_init:
-                            syslog.syslog(
-                                syslog.LOG_WARNING, f"Failed to delete "
-                                f"{path}: Directory not found")
-                    except OSError:
-                        # Fail silently if the directory is not empty.
-                        break
+                            syslog.LOG_WARNING, f"Failed to delete "
+                            f"{path}: Directory not found")
+                except OSError:
+                    # Fail silently if the directory is not empty.
+                    break
 
     def _create_snapshot_error_handler(
             function: typing.Callable[..., int]) -> typing.Callable[..., int]:
@@ -416,22 +991,66 @@ class Service(object):
 
     @_create_snapshot_error_handler
     def _create_snapshot(
-            self, type: timewarp.service.snapper.SnapshotType) -> int:
-        if timewarp.service.snapper.SnapshotType.PRE == type:
-            # Create a pre-snapshot.
-            snapshot = self._snapper.create_pre_snapshot(
-                self._configuration.snapper.description, self._userdata)
-        elif timewarp.service.snapper.SnapshotType.POST == type:
-            # Create a post-snapshot.  Raises NoPreSnapshotError if no
-            # pre-snapshot has been created earlier.
-            snapshot = self._snapper.create_post_snapshot("", self._userdata)
-        else:
-            # Create a single snapshot.
-            snapshot = self._snapper.create_single_snapshot(
-                self._configuration.snapper.description, self._userdata)
+            self, type: timewarp.service.snapper.SnapshotType,
+            userdata: typing.Mapping[str, str], session: str = "",
+            job: timewarp.service.job.Job = None) -> int:
+        try:
+            with self._lock:
+                with self._metrics.measure("create"):
+                    number = self._create_snapshot_locked(
+                        type, userdata, session, job)
+
+                # The boot environments are pruned at the end of the
+                # reconciliation, which must not be waited for while holding
+                # the lock.  The snapshot has been created at this point, so
+                # errors while pruning are logged without failing the
+                # creation.
+                if self._reconciled.is_set():
+                    try:
+                        self._prune()
+                    except timewarp.error.InitializationError as e:
+                        syslog.syslog(
+                            syslog.LOG_ERR, f"Failed to prune boot "
+                            f"environments: {e.message}")
+                    except Exception as e:
+                        syslog.syslog(
+                            syslog.LOG_ERR, f"Failed to prune boot "
+                            f"environments: Unexpected error: {e}")
+        finally:
+            # Clean up after the snapshots which have been deleted while the
+            # lock was held, see _clean_up_pending.
+            if self._pending:
+                GLib.idle_add(self._clean_up_pending)
+
+        return number
+
+    def _create_snapshot_locked(
+            self, type: timewarp.service.snapper.SnapshotType,
+            userdata: typing.Mapping[str, str], session: str,
+            job: typing.Optional[timewarp.service.job.Job]) -> int:
+        if job is not None:
+            job.set_progress(0.0, "snapshot")
+
+        with self._metrics.measure("create.snapper"):
+            if timewarp.service.snapper.SnapshotType.PRE == type:
+                # Create a pre-snapshot.
+                snapshot = self._snapper.create_pre_snapshot(
+                    self._configuration.snapper.description, userdata,
+                    session)
+            elif timewarp.service.snapper.SnapshotType.POST == type:
+                # Create a post-snapshot.  Raises NoPreSnapshotError if no
+                # pre-snapshot has been created earlier within the session.
+                snapshot = self._snapper.create_post_snapshot(
+                    "", userdata, session)
+            else:
+                # Create a single snapshot.
+                snapshot = self._snapper.create_single_snapshot(
+                    self._configuration.snapper.description, userdata)
 
         # This should normally only fail if you uninstalled your kernel.
-        package = self._root_database.get_packages_by_name(self._linux)[-1]
+        with self._metrics.measure("create.package"):
+            package = self._root_database.get_packages_by_name(
+                self._linux)[-1]
 
         # Extend the default mapping with the snapshot and kernel package.
         mapping = {
@@ -440,42 +1059,435 @@ class Service(object):
             "linux": package
         }
 
-        # Copy kernel and initrd images.
-        for source, destination in self._configuration.filter_files(
-                mapping).items():
-            if destination.exists():
+        number = snapshot.number
+        files = self._configuration.filter_files(mapping)
+        entry = self._configuration.format(
+            mapping, self._configuration.boot.entry)
+
+        # Record the intent to create the boot environment so that creation
+        # can be resumed if timewarpd is interrupted.
+        self._journal.begin(number, {
+            "linux": {"name": package.name, "version": package.version},
+            "files": [
+                [str(source), str(destination)]
+                for source, destination in files.items()],
+            "entry": entry,
+            "userdata": snapshot.userdata
+        })
+
+        self._create_boot_environment(
+            number, package, files, entry, snapshot.userdata, job=job)
+
+        if job is not None:
+            job.set_progress(1.0, "done")
+
+        return number
+
+    def _create_boot_environment(
+            self, number: int, package: timewarp.service.package.Package,
+            files: typing.Mapping[pathlib.Path, pathlib.Path],
+            entry: timewarp.namespace.Namespace,
+            userdata: typing.Optional[typing.Mapping[str, str]],
+            stage: str = "images",
+            job: timewarp.service.job.Job = None) -> None:
+        try:
+            self._create_boot_environment_staged(
+                number, package, files, entry, userdata, stage, job)
+        except BaseException:
+            # Undo the stages which have been run and record the failure so
+            # that the journal does not keep the operation pending.  Kernel
+            # and initrd images must not be removed before the boot
+            # environments have been reconciled, so the clean-up is postponed
+            # until then, see _clean_up_pending.
+            if self._reconciled.is_set():
+                self._clean_up([number])
+            else:
+                self._pending.add(number)
+
+            self._journal.fail(number)
+            raise
+
+    def _create_boot_environment_staged(
+            self, number: int, package: timewarp.service.package.Package,
+            files: typing.Mapping[pathlib.Path, pathlib.Path],
+            entry: timewarp.namespace.Namespace,
+            userdata: typing.Optional[typing.Mapping[str, str]],
+            stage: str, job: typing.Optional[timewarp.service.job.Job]) -> \
+            None:
+        stages = ["images", "bootenv", "entry"]
+        bootenv = self._bootenvs / str(number)
+
+        if job is not None:
+            job.set_progress(0.25, "images")
+
+        # Copying is idempotent, so images are copied even when resuming a
+        # later stage.  This also points the entry at the stored images when
+        # using the image store.
+        if stages.index(stage) <= 0:
+            self._journal.record(number, "images")
+
+        copied = self._copy_images(number, files, entry)
+
+        if job is not None:
+            job.set_progress(0.5, "bootenv")
+
+        if stages.index(stage) <= 1:
+            self._journal.record(number, "bootenv")
+
+        # Create the boot environment unless it has been created before
+        # timewarpd was interrupted or its creation is deferred.
+        with self._metrics.measure("create.bootenv"):
+            if not self._lazy and not bootenv.exists():
+                try:
+                    self._btrfs.snapshot(
+                        self._snapshots / str(number) / "snapshot", bootenv)
+                except timewarp.error.SubvolumeError as e:
+                    raise timewarp.error.SubvolumeError(
+                        f"Failed to create boot environment {bootenv}: "
+                        f"{e.message}")
+
+        # The boot environment has been created from a snapshot of / so it is
+        # using the same kernel as the root package database.
+        self._add_to_index(number, package)
+
+        if job is not None:
+            job.set_progress(0.75, "entry")
+
+        self._journal.record(number, "entry")
+
+        # Add the new boot loader entry.  If adding the entry has been
+        # interrupted, the entry might exist already.
+        with self._loader_lock, self._metrics.measure("create.entry"), \
+                self._loader.transaction():
+            if "entry" == stage:
+                self._loader.remove_entry(number)
+
+            self._loader.add_entry(
+                number, timewarp.service.boot.Entry(**entry))
+
+        # Record the new boot environment in the state index.
+        with self._metrics.measure("create.state"):
+            self._state.add_boot_environment(
+                number, bootenv, package, copied, entry, userdata)
+            self._journal.complete(number)
+
+    def _create_boot_environments(
+            self, numbers: typing.Iterable[int]) -> \
+            typing.Mapping[int, typing.Optional[str]]:
+        # Returns a snapshot number: error message mapping, the error message
+        # is None if the boot environment has been created.
+        numbers = sorted(set(numbers))
+        errors = {}
+        snapshots = {}
+
+        for number in numbers:
+            bootenv = self._bootenvs / str(number)
+
+            try:
+                if self._is_boot_environment(number):
+                    raise timewarp.error.SubvolumeError(
+                        f"Boot environment {bootenv} already exists")
+
+                if not (self._snapshots / str(number) / "snapshot").exists():
+                    raise timewarp.error.SubvolumeError(
+                        f"Snapshot {number} does not exist")
+
+                snapshots[number] = self._snapper.get_snapshot(number)
+            except timewarp.error.SubvolumeError as e:
+                errors[number] = e.message
+            except GLib.Error as e:
+                errors[number] = f"Failed to query snapshot {number}: " \
+                    f"{timewarp.error.DBusError(e.code)}"
+
+        # The boot environments are going to be snapshots of the snapshots so
+        # the kernel package is read from the snapshot package databases, each
+        # of them once.
+        with concurrent.futures.ThreadPoolExecutor(self._workers) as executor:
+            packages = dict(zip(snapshots, executor.map(
+                self._query_snapshot_kernel, snapshots)))
+
+        entries = {}
+
+        for number, (package, error) in packages.items():
+            if error is not None:
+                errors[number] = error
                 continue
 
-            path = destination.parent
+            # Extend the default mapping with the snapshot and kernel package.
+            mapping = {
+                **self._default_mapping,
+                "snapshot": snapshots[number],
+                "linux": package
+            }
+
+            files = self._configuration.filter_files(mapping)
+            entry = self._configuration.format(
+                mapping, self._configuration.boot.entry)
 
-            if not path.exists():
-                path.mkdir(parents=True)
+            self._journal.begin(number, {
+                "linux": {"name": package.name, "version": package.version},
+                "files": [
+                    [str(source), str(destination)]
+                    for source, destination in files.items()],
+                "entry": entry,
+                "userdata": snapshots[number].userdata
+            })
+            self._journal.record(number, "images")
 
             try:
-                shutil.copy2(source, destination)
-            except FileNotFoundError:
-                syslog.syslog(
-                    syslog.LOG_WARNING, f"Failed to copy kernel or "
-                    f"initrd image: Source file {source} not found")
+                entries[number] = entry, self._copy_images(
+                    number, files, entry)
+            except Exception as e:
+                errors[number] = f"Unexpected error: {e}"
+                self._journal.fail(number)
 
-        number = snapshot.number
+        # All boot environments are created first, then all boot loader
+        # entries are added at once.
+        for number in list(entries):
+            bootenv = self._bootenvs / str(number)
+            self._journal.record(number, "bootenv")
+
+            try:
+                with self._metrics.measure("create.bootenv"):
+                    if not self._lazy:
+                        self._btrfs.snapshot(
+                            self._snapshots / str(number) / "snapshot",
+                            bootenv)
+            except timewarp.error.SubvolumeError as e:
+                errors[number] = f"Failed to create boot environment " \
+                    f"{bootenv}: {e.message}"
+                del entries[number]
+                self._journal.fail(number)
+                continue
+
+            self._add_to_index(number, packages[number][0])
+            self._journal.record(number, "entry")
+
+        # All boot loader entries are added in a single transaction, so either
+        # all of them or none are added.
+        try:
+            with self._loader_lock, self._metrics.measure("create.entry"), \
+                    self._loader.transaction():
+                self._loader.add_entries({
+                    number: timewarp.service.boot.Entry(**entry)
+                    for number, (entry, _) in entries.items()})
+        except Exception as e:
+            # The boot environments which have been created are deleted again
+            # and the failures recorded, so that the journal does not keep
+            # the operations pending.
+            self._clean_up(entries)
+
+            for number in entries:
+                errors[number] = f"Unexpected error: {e}"
+                self._journal.fail(number)
+
+            entries = {}
+
+        for number, (entry, copied) in entries.items():
+            self._state.add_boot_environment(
+                number, self._bootenvs / str(number), packages[number][0],
+                copied, entry, snapshots[number].userdata)
+            self._journal.complete(number)
+            errors[number] = None
+
+        for number, error in errors.items():
+            if error is not None:
+                syslog.syslog(syslog.LOG_ERR, error)
+
+        return errors
+
+    def _query_snapshot_kernel(
+            self, number: int) -> typing.Tuple[
+            typing.Optional[timewarp.service.package.Package],
+            typing.Optional[str]]:
+        snapshot = self._snapshots / str(number) / "snapshot"
+
+        try:
+            return self._get_kernel(number, snapshot), None
+        except timewarp.error.InitializationError as e:
+            return None, f"Failed to initialize package database of " \
+                f"snapshot {snapshot}: {e.message}"
+        except timewarp.error.InvalidPackageInformationError:
+            return None, f"Failed to query package database of snapshot " \
+                f"{snapshot}: Package information for kernel package " \
+                f"{self._linux} is invalid"
+        except timewarp.error.PackageNotFoundError:
+            return None, f"Failed to query package database of snapshot " \
+                f"{snapshot}: Kernel package {self._linux} not found"
+
+    def _get_source(self, number: int) -> pathlib.Path:
+        # Deferred boot environments are going to be snapshots of the
+        # snapshots, so the snapshot package database is queried instead.
+        bootenv = self._bootenvs / str(number)
+        return bootenv if bootenv.exists() \
+            else self._snapshots / str(number) / "snapshot"
+
+    def _materialize(self, number: int) -> typing.Optional[str]:
+        # Returns None on success or the error message on error.
+        bootenv = self._bootenvs / str(number)
+
+        if bootenv.exists():
+            return None
+
+        if not self._is_boot_environment(number):
+            message = f"Boot environment {bootenv} does not exist"
+        elif not (self._snapshots / str(number) / "snapshot").exists():
+            message = f"Snapshot {number} does not exist"
+        else:
+            try:
+                with self._metrics.measure("materialize"):
+                    self._btrfs.snapshot(
+                        self._snapshots / str(number) / "snapshot", bootenv)
+
+                return None
+            except timewarp.error.SubvolumeError as e:
+                message = f"Failed to create boot environment {bootenv}: " \
+                    f"{e.message}"
+
+        syslog.syslog(syslog.LOG_ERR, message)
+        return message
+
+    def _prune(self) -> typing.Mapping[int, typing.Optional[str]]:
+        # Returns a snapshot number: error message mapping of the pruned boot
+        # environments, see _clean_up.
+        if not self._retention.enabled:
+            return {}
+
+        with self._index_lock:
+            kernels = {
+                number: package.version if package is not None else None
+                for number, package in self._bootenv_kernels.items()}
+
+        userdata = self._state.get_userdata()
+
+        # The userdata of boot environments created by earlier versions is
+        # queried from Snapper once.
+        if self._retention.important:
+            for number in kernels:
+                if userdata.get(number) is not None:
+                    continue
+
+                try:
+                    userdata[number] = self._snapper.get_snapshot(
+                        number).userdata
+                    self._state.set_userdata(number, userdata[number])
+                except GLib.Error:
+                    pass
+
+        # The boot environment in use is never pruned.
+        subvol = timewarp.service.block.FileSystem("/").subvol
+        numbers = [
+            number
+            for number in self._retention.select(kernels, userdata)
+            if self._bootenvs / str(number) != subvol]
+
+        if not numbers:
+            return {}
+
+        syslog.syslog(
+            syslog.LOG_INFO, f"Pruning boot environments "
+            f"{', '.join(map(str, sorted(numbers)))}")
+
+        # All boot environments are deleted in a single pass.
+        with self._lock, concurrent.futures.ThreadPoolExecutor(
+                self._workers) as executor:
+            return self._clean_up(numbers, executor)
+
+    def _resume(
+            self, number: int,
+            operation: typing.Mapping[str, typing.Any]) -> None:
         bootenv = self._bootenvs / str(number)
 
-        # Create the boot environment.
+        # The snapshot might have been deleted in the meantime, in which case
+        # the orphaned boot environment is cleaned up later on.
+        if not (self._snapshots / str(number) / "snapshot").exists():
+            self._journal.complete(number)
+            return
+
         try:
-            sh.btrfs.subvolume.snapshot(
-                self._snapshots / str(number) / "snapshot", bootenv)
-        except sh.ErrorReturnCode:
-            raise timewarp.error.SubvolumeError(
-                f"Failed to create boot environment {bootenv}")
-
-        # Add the new boot loader entry.
-        self._loader.add_entry(
-            number, timewarp.service.boot.Entry(
-                **self._configuration.format(
-                    mapping, self._configuration.boot.entry)))
+            with self._lock:
+                self._create_boot_environment(
+                    number, timewarp.service.package.Package(
+                        **operation["linux"]), {
+                        pathlib.Path(source): pathlib.Path(destination)
+                        for source, destination in operation["files"]},
+                    timewarp.namespace.Namespace(**operation["entry"]),
+                    operation.get("userdata"),
+                    "images" if "begin" == operation["stage"]
+                    else operation["stage"])
+        except timewarp.error.SubvolumeError as e:
+            syslog.syslog(
+                syslog.LOG_ERR, f"Failed to resume creation of boot "
+                f"environment {bootenv}: {e.message}")
+        except Exception as e:
+            syslog.syslog(
+                syslog.LOG_ERR, f"Failed to resume creation of boot "
+                f"environment {bootenv}: Unexpected error: {e}")
 
-        return number
+    def _copy_images(
+            self, number: int,
+            files: typing.Mapping[pathlib.Path, pathlib.Path],
+            entry: timewarp.namespace.Namespace) -> \
+            typing.List[pathlib.Path]:
+        copied = []
+
+        # Copy kernel and initrd images.
+        with self._metrics.measure("create.images"):
+            for source, destination in files.items():
+                if self._store is not None:
+                    file = self._add_to_store(
+                        number, source, destination, entry)
+
+                    if file is not None:
+                        copied.append(file)
+
+                    continue
+
+                path = destination.parent
+
+                if not path.exists():
+                    path.mkdir(parents=True)
+
+                # Images which are identical to the source images are skipped.
+                try:
+                    self._copier.copy(source, destination)
+                    copied.append(destination)
+                except FileNotFoundError:
+                    syslog.syslog(
+                        syslog.LOG_WARNING, f"Failed to copy kernel or "
+                        f"initrd image: Source file {source} not found")
+
+        return copied
+
+    def _add_to_store(
+            self, number: int, source: pathlib.Path,
+            destination: pathlib.Path,
+            entry: timewarp.namespace.Namespace) -> \
+            typing.Optional[pathlib.Path]:
+        try:
+            file = self._store.add(source, number)
+        except FileNotFoundError:
+            syslog.syslog(
+                syslog.LOG_WARNING, f"Failed to copy kernel or initrd image: "
+                f"Source file {source} not found")
+            return None
+
+        # Point the boot loader entry at the stored image instead of the
+        # destination file.  The entry might contain a prefix such as the
+        # subvolume which we have to keep.
+        suffix = str(destination.relative_to(self._mount_point))
+        replacement = str(file.relative_to(self._mount_point))
+
+        def replace(path: str) -> str:
+            return path[:-len(suffix)] + replacement \
+                if path.endswith(f"/{suffix}") else path
+
+        entry["linux"] = replace(entry["linux"])
+
+        if entry.initrd is not None:
+            entry["initrd"] = [replace(path) for path in entry.initrd]
+
+        return file
 
     def _monitor_handler(
             self, monitor: Gio.FileMonitor, child: Gio.File,
@@ -486,10 +1498,46 @@ class Service(object):
         except ValueError:
             return
 
-        bootenv = self._bootenvs / str(number)
+        if Gio.FileMonitorEvent.DELETED == event_type and \
+                self._is_boot_environment(number):
+            # Snapper usually deletes several snapshots at once so we are
+            # collecting the deleted snapshots and clean up after a short
+            # delay, removing all of them in a single pass.
+            self._pending.add(number)
+
+            if not self._pending_source:
+                self._pending_source = GLib.timeout_add(
+                    self._cleanup_delay, self._clean_up_pending)
+
+    def _clean_up_pending(self) -> bool:
+        # Do not block the main event loop while the boot environments are
+        # still being reconciled or a snapshot is being created on the job
+        # worker thread.  The deleted snapshots are kept pending instead and
+        # this is scheduled again by _reconcile or _create_snapshot
+        # respectively once they are done.
+        self._pending_source = 0
+
+        if not self._reconciled.is_set() or \
+                not self._lock.acquire(blocking=False):
+            return False
+
+        try:
+            numbers = self._pending
+            self._pending = set()
+            self._clean_up(numbers)
+        finally:
+            self._lock.release()
 
-        if Gio.FileMonitorEvent.DELETED == event_type and bootenv.exists():
-            self._clean_up(number)
+        # Remove the source.
+        return False
+
+    def _emit_job_completed(self, id: str, state: str, number: int) -> bool:
+        self.JobCompleted(id, state, number)
+        return False
+
+    def _emit_job_progress(self, id: str, progress: float, stage: str) -> bool:
+        self.JobProgress(id, progress, stage)
+        return False
 
     def _signal_handler(self, number, frame) -> None:
         self._loop.quit()
@@ -500,9 +1548,19 @@ def main(args: typing.List[str] = None) -> None:
     if args is None:
         args = sys.argv[1:]
 
+    # Process command line arguments.
+    parser = argh.ArghParser(prog="timewarpd")
+    parser.add_argument(
+        "--verify", action="store_true", help="verify the state index against "
+        "the boot environments and repair it")
+    parser.add_argument(
+        "--session-bus", action="store_true", help="use the D-Bus session bus "
+        "instead of the system bus")
+    namespace = parser.parse_args(args)
+
     try:
         # Initialize the Time Warp service and start it.
-        service = Service()
+        service = Service(namespace.verify, namespace.session_bus)
         service.start()
     except timewarp.error.InitializationError as e:
         print(f"Failed to start timewarpd: {e.message}.")
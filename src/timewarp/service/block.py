@@ -4,15 +4,242 @@
 # All rights reserved.
 #
 
-import json
+import os
 import pathlib
-import sh
+import re
+import select
+import threading
 import typing
 
 import timewarp.error
 import timewarp.namespace
 
 
+class Topology(object):
+    """
+    Block device topology, read from /proc/self/mountinfo, sysfs and the udev
+    device links.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+    _mountinfo = None
+    _poll = None
+    _uuids_mtime = None
+
+    def __init__(self) -> None:
+        self.mounts = []
+        self._device_names = {}
+        self._targets = {}
+
+        # See proc(5) for a description of the mountinfo format.
+        try:
+            with open("/proc/self/mountinfo", "r") as f:
+                for line in f:
+                    fields = line.split()
+                    separator = fields.index("-")
+                    self.mounts.append(timewarp.namespace.Namespace(
+                        target=self._unescape(fields[4]),
+                        fstype=fields[separator + 1],
+                        source=self._unescape(fields[separator + 2]),
+                        options=f"{fields[5]},{fields[separator + 3]}"))
+
+                    # Mounts are listed in mount order so later mounts on the
+                    # same mount point are on top.
+                    self._targets[self.mounts[-1].target] = self.mounts[-1]
+        except OSError:
+            raise timewarp.error.InitializationError(
+                "Unable to read /proc/self/mountinfo")
+
+        # Map kernel device names to file system UUIDs.
+        self.uuids = {}
+
+        for link in pathlib.Path("/dev/disk/by-uuid").glob("*"):
+            self.uuids[pathlib.Path(os.path.realpath(link)).name] = link.name
+
+        # Index the partitions by file system UUID.  This way, the partition a
+        # file system is located on can be looked up without walking the
+        # block device hierarchy.
+        self.partitions = {}
+        self._partition_table_types = {}
+
+        for name, uuid in self.uuids.items():
+            partition = self.find_partition(name)
+
+            if partition is not None:
+                self.partitions.setdefault(uuid, partition)
+
+    @classmethod
+    def get(cls) -> "Topology":
+        """
+        Returns the process-wide block device topology.  The topology is read
+        again only if the mount table has changed or block devices have been
+        added or removed since it has been read the last time.
+        """
+        with cls._lock:
+            changed = cls._changed()
+
+            if cls._instance is None or changed:
+                cls._instance = cls()
+
+            return cls._instance
+
+    @classmethod
+    def _changed(cls) -> bool:
+        changed = False
+
+        # The kernel signals changes of the mount table by marking
+        # /proc/self/mountinfo with a priority event, see proc(5).  Polling
+        # also resets the event.
+        if cls._poll is None:
+            try:
+                cls._mountinfo = open("/proc/self/mountinfo", "r")
+                cls._poll = select.poll()
+                cls._poll.register(
+                    cls._mountinfo, select.POLLPRI | select.POLLERR)
+            except OSError:
+                cls._poll = None
+
+            changed = True
+        elif cls._poll.poll(0):
+            changed = True
+
+        # udev updates the device links whenever a block device has been
+        # added or removed or its file system UUID has changed.
+        try:
+            mtime = os.stat("/dev/disk/by-uuid").st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if mtime != cls._uuids_mtime:
+            cls._uuids_mtime = mtime
+            changed = True
+
+        # Without change notification we have to assume that anything might
+        # have changed.
+        return changed or cls._poll is None
+
+    def find_mount(
+            self, mount_point: str) -> \
+            typing.Optional[timewarp.namespace.Namespace]:
+        """
+        Returns the file system mounted on mount_point or None if mount_point
+        is not a mount point.  If several file systems are mounted on top of
+        each other, the topmost one is returned.
+
+        Keyword arguments:
+        mount_point -- the mount point
+        """
+        return self._targets.get(os.path.realpath(mount_point))
+
+    def find_partition(self, name: str) -> typing.Optional[str]:
+        """
+        Returns the name of the partition the block device identified by name
+        is located on or None if there is no such partition.
+
+        Keyword arguments:
+        name -- the kernel device name
+        """
+        return self._find_partition(name, set())
+
+    def get_device_name(self, source: str) -> typing.Optional[str]:
+        """
+        Returns the kernel device name of a mount source or None if the mount
+        source is not a block device.
+
+        Keyword arguments:
+        source -- the mount source
+        """
+        if not source.startswith("/dev/"):
+            return None
+
+        if source not in self._device_names:
+            name = pathlib.Path(os.path.realpath(source)).name
+            self._device_names[source] = name \
+                if (pathlib.Path("/sys/class/block") / name).exists() else None
+
+        return self._device_names[source]
+
+    def get_partition_table_type(self, name: str) -> typing.Optional[str]:
+        """
+        Returns the partition table type of the disk containing the partition
+        identified by name.
+
+        Keyword arguments:
+        name -- the kernel device name of the partition
+        """
+        if name not in self._partition_table_types:
+            self._partition_table_types[name] = \
+                self._read_partition_table_type(name)
+
+        return self._partition_table_types[name]
+
+    def _read_partition_table_type(self, name: str) -> typing.Optional[str]:
+        # The parent directory of a partition in sysfs is the disk.
+        disk = pathlib.Path(os.path.realpath(
+            pathlib.Path("/sys/class/block") / name)).parent.name
+
+        # Prefer the udev database, which contains the results of blkid
+        # probing.
+        for device in [name, disk]:
+            try:
+                with open(
+                        pathlib.Path("/sys/class/block") / device / "dev",
+                        "r") as f:
+                    number = f.read().strip()
+
+                with open(f"/run/udev/data/b{number}", "r") as f:
+                    for line in f:
+                        if line.startswith("E:ID_PART_TABLE_TYPE="):
+                            return line.strip().split("=", 1)[1]
+            except OSError:
+                pass
+
+        # Fall back on probing the disk header.  GPT disks have a protective
+        # MBR as well so we are checking for GPT first.
+        try:
+            with open(f"/dev/{disk}", "rb") as f:
+                buffer = f.read(4096 + 8)
+        except OSError:
+            return None
+
+        if b"EFI PART" in [buffer[512:520], buffer[4096:4104]]:
+            return "gpt"
+        elif b"\x55\xaa" == buffer[510:512]:
+            return "dos"
+
+        return None
+
+    def _find_partition(
+            self, name: str, visited: typing.Set[str]) -> \
+            typing.Optional[str]:
+        if name in visited:
+            return None
+
+        visited.add(name)
+        path = pathlib.Path("/sys/class/block") / name
+
+        if (path / "partition").exists():
+            # The current block device is a partition so we found it.
+            return name
+
+        # Traverse the underlying block devices, e.g. of device mapper or MD
+        # devices.
+        for slave in sorted((path / "slaves").glob("*")):
+            partition = self._find_partition(slave.name, visited)
+
+            if partition is not None:
+                return partition
+
+        return None
+
+    @staticmethod
+    def _unescape(value: str) -> str:
+        # Spaces, tabs, newlines and backslashes are octal-escaped.
+        return re.sub(
+            r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), value)
+
+
 class Block(object):
     """Block device."""
 
@@ -23,92 +250,59 @@ class Block(object):
 class FileSystem(Block):
     """File system block device."""
 
-    def __init__(self, mount_point: str) -> None:
+    def __init__(self, mount_point: str, topology: Topology = None) -> None:
         super().__init__()
 
-        # Get the mount target, file system type, UUID and mount options for
+        if topology is None:
+            topology = Topology.get()
+
+        # Get the mount target, file system type, source and mount options for
         # the file system.
-        try:
-            block = json.loads(
-                str(sh.findmnt(
-                    mount_point, "-J", "-o", "TARGET,FSTYPE,UUID,OPTIONS")),
-                object_hook=lambda kwargs: timewarp.namespace.Namespace(
-                    **kwargs))
-        except sh.CommandNotFound:
-            raise timewarp.error.InitializationError(
-                "findmnt: Command not found")
-        except sh.ErrorReturnCode:
+        mount = topology.find_mount(mount_point)
+
+        if mount is None:
             raise timewarp.error.InitializationError(
                 f"Invalid mount point {mount_point}")
 
         self.subvol = None
 
-        for option in block.filesystems[0].options.split(","):
+        for option in mount.options.split(","):
             if option.startswith("subvol="):
                 self.subvol = pathlib.Path(option.split("=")[-1])
                 break
 
-        self.file_system_type = block.filesystems[0].fstype
-        self.uuid = block.filesystems[0].uuid
+        self.file_system_type = mount.fstype
+        self.name = topology.get_device_name(mount.source)
+        self.uuid = topology.uuids.get(self.name)
 
 
 class Partition(Block):
     """Partition block device."""
 
-    def __init__(self, mount_point: str) -> None:
+    def __init__(self, mount_point: str, topology: Topology = None) -> None:
         super().__init__()
 
-        # In case Btrfs subvolumes are being used, lsblk might not be able to
-        # properly determine the mount points.  To work around this, we first
-        # determine the file system UUID and use it to find the correct
-        # partition.
-        file_system = FileSystem(mount_point)
+        if topology is None:
+            topology = Topology.get()
 
-        # Get the device name, path to the device node, file system UUID,
-        # partition table type and device type for all block devices.
-        try:
-            root = json.loads(
-                str(sh.lsblk("-J", "-o", "NAME,PATH,UUID,PTTYPE,TYPE")),
-                object_hook=lambda kwargs: timewarp.namespace.Namespace(
-                    **kwargs))
-        except sh.CommandNotFound:
-            raise timewarp.error.InitializationError(
-                "lsblk: Command not found")
+        # In case Btrfs subvolumes are being used, the mount source might not
+        # be the partition itself.  To work around this, we first determine
+        # the file system UUID and use it to look up the partition.
+        file_system = FileSystem(mount_point, topology)
 
-        # Try to find the partition.
-        partition, found = self._find_partition(root, file_system.uuid)
+        if file_system.uuid is not None:
+            partition = topology.partitions.get(file_system.uuid)
+        elif file_system.name is not None:
+            partition = topology.find_partition(file_system.name)
+        else:
+            partition = None
 
-        if found:
-            self.path = partition.path
-            self.uuid = partition.uuid
-            self.partition_table_type = partition.pttype
+        if partition is not None:
+            self.path = f"/dev/{partition}"
+            self.uuid = topology.uuids.get(partition)
+            self.partition_table_type = topology.get_partition_table_type(
+                partition)
         else:
             self.path = None
             self.uuid = None
             self.partition_table_type = None
-
-    def _find_partition(
-            self, root: timewarp.namespace.Namespace, file_system_uuid: str,
-            partition: timewarp.namespace.Namespace = None,
-            found: bool = False) -> typing.Tuple[typing.Optional[str], bool]:
-        if not found:
-            if "type" in root and "part" == root.type:
-                # The current block device is a partition so we save it.
-                partition = root
-
-            if "uuid" in root and file_system_uuid == root.uuid:
-                # The current UUID matches the file system UUID, this means we
-                # found the right partition.
-                found = True
-
-            # Traverse sub-elements.
-            if "blockdevices" in root:
-                for block_device in root.blockdevices:
-                    partition, found = self._find_partition(
-                        block_device, file_system_uuid, partition, found)
-            elif "children" in root:
-                for child in root.children:
-                    partition, found = self._find_partition(
-                        child, file_system_uuid, partition, found)
-
-        return partition, found
@@ -4,6 +4,7 @@
 # All rights reserved.
 #
 
+import contextlib
 import pathlib
 import typing
 
@@ -26,7 +27,10 @@ class Entry(object):
 
 
 class Loader(object):
-    """Boot loader."""
+    """
+    Boot loader.  Changes to the boot loader entries can be grouped into
+    transactions, which are staged in memory and written at once on commit.
+    """
 
     def __init__(
             self, mount_point: pathlib.Path,
@@ -34,6 +38,10 @@ class Loader(object):
         if type(self) is Loader:
             raise NotImplementedError
 
+        # Snapshot number: staged entry mapping of the current transaction,
+        # the entry is None if it is to be removed.
+        self._staged = None
+
     def add_entry(self, number: int, entry: Entry) -> None:
         """
         Adds a new boot loader entry.
@@ -44,6 +52,19 @@ class Loader(object):
         """
         raise NotImplementedError
 
+    def add_entries(self, entries: typing.Mapping[int, Entry]) -> None:
+        """
+        Adds multiple boot loader entries.  Within a transaction, the entries
+        are staged until the transaction is committed.
+
+        Keyword arguments:
+        entries -- a snapshot number: entry mapping
+        """
+        if self._staged is not None:
+            self._staged.update(entries)
+        elif entries:
+            self._update(entries, [])
+
     def remove_entry(self, number: int) -> None:
         """
         Removes a boot loader entry.
@@ -52,3 +73,85 @@ class Loader(object):
         number -- the snapshot number
         """
         raise NotImplementedError
+
+    def remove_entries(self, numbers: typing.Iterable[int]) -> None:
+        """
+        Removes multiple boot loader entries.  Within a transaction, the
+        removals are staged until the transaction is committed.
+
+        Keyword arguments:
+        numbers -- the snapshot numbers
+        """
+        numbers = list(numbers)
+
+        if self._staged is not None:
+            self._staged.update((number, None) for number in numbers)
+        elif numbers:
+            self._update({}, numbers)
+
+    def begin(self) -> None:
+        """
+        Begins a transaction.  Raises RuntimeError if a transaction is in
+        progress already.
+        """
+        if self._staged is not None:
+            raise RuntimeError("Transaction in progress")
+
+        self._staged = {}
+
+    def commit(self) -> None:
+        """
+        Commits the current transaction, writing all staged changes at once.
+        If writing fails, the boot loader entries are left unchanged as far
+        as the boot loader allows and the transaction is kept open, so that
+        it can be committed again or rolled back.
+        """
+        staged = self._staged
+
+        # The changes are applied directly while writing them.
+        self._staged = None
+
+        try:
+            if staged:
+                self._update(
+                    {
+                        number: entry for number, entry in staged.items()
+                        if entry is not None},
+                    [
+                        number for number, entry in staged.items()
+                        if entry is None])
+        except BaseException:
+            self._staged = staged
+            raise
+
+    def rollback(self) -> None:
+        """Discards all changes staged in the current transaction."""
+        self._staged = None
+
+    @contextlib.contextmanager
+    def transaction(self) -> typing.Iterator[None]:
+        """
+        Runs the enclosed block in a transaction, which is committed if the
+        block succeeds and rolled back otherwise, including if committing
+        fails.
+        """
+        self.begin()
+
+        try:
+            yield
+            self.commit()
+        except BaseException:
+            self.rollback()
+            raise
+
+    def _update(
+            self, entries: typing.Mapping[int, Entry],
+            numbers: typing.Sequence[int]) -> None:
+        # Removes the entries of numbers and adds entries, replacing existing
+        # entries for the same snapshots.  Boot loaders which are able to
+        # apply several changes at once should override this method.
+        for number in sorted(set(numbers).union(entries)):
+            self.remove_entry(number)
+
+        for number, entry in sorted(entries.items()):
+            self.add_entry(number, entry)
@@ -4,8 +4,11 @@
 # All rights reserved.
 #
 
+import os
 import pathlib
 import re
+import tempfile
+import typing
 
 import timewarp.error
 import timewarp.service.block
@@ -25,6 +28,34 @@ class GRUB(timewarp.service.boot.Loader):
             raise timewarp.error.InitializationError(
                 f"Directory {self._path} does not exist")
 
+        self._probe(mount_point, boot_on_root)
+
+        # Snapshot number: entry index of the configuration file, see
+        # _get_index.
+        self._index = None
+        self._key = None
+
+    def add_entry(
+            self, number: int, entry: timewarp.service.boot.Entry) -> None:
+        """
+        Adds a new GRUB boot loader entry.
+
+        Keyword arguments:
+        number -- the snapshot number
+        entry  -- the entry to add
+        """
+        self.add_entries({number: entry})
+
+    def remove_entry(self, number: int) -> None:
+        """
+        Removes a GRUB boot loader entry.
+
+        Keyword arguments:
+        number -- the snapshot number
+        """
+        self.remove_entries([number])
+
+    def _probe(self, mount_point: pathlib.Path, boot_on_root: bool) -> None:
         # GRUB needs information about the boot partition device in order to be
         # able to find the kernel and initrd images.  The same information also
         # needs to be passed to the "search" command.
@@ -86,27 +117,125 @@ class GRUB(timewarp.service.boot.Loader):
         elif "vfat" == self._boot_file_system.file_system_type:
             self._modules.append("fat")
 
-    def add_entry(
-            self, number: int, entry: timewarp.service.boot.Entry) -> None:
-        """
-        Adds a new GRUB boot loader entry.
+    def _update(
+            self, entries: typing.Mapping[int, timewarp.service.boot.Entry],
+            numbers: typing.Sequence[int]) -> None:
+        # All changes are applied to the index first and written with a
+        # single atomic replace of the configuration file.  The index is
+        # restored if writing fails.
+        index = self._get_index()
+        saved = dict(index)
+        changed = bool(entries)
 
-        Keyword arguments:
-        number -- the snapshot number
-        entry  -- the entry to add
-        """
-        lf = "\n"
-        options = []
-        buffer = ""
+        for number in numbers:
+            changed = index.pop(number, None) is not None or changed
+
+        # Newer entries are put on top.
+        for number, entry in sorted(entries.items()):
+            index.pop(number, None)
+            index[number] = self._format_entry(number, entry).strip()
+
+        if not changed:
+            return
 
         try:
-            with open(self._path / "grub-timewarp.cfg", "r") as f:
-                m = re.search("(?P<entries>###.*###)", f.read(), re.DOTALL)
+            self._write()
+        except BaseException:
+            self._index = saved
+            raise
+
+    def _get_index(self) -> typing.Dict[int, str]:
+        # Returns the snapshot number: entry index in the order the entries
+        # have been added.  The configuration file is only parsed again if
+        # it has been modified by someone else.
+        file = self._path / "grub-timewarp.cfg"
 
-                if m:
-                    buffer = m.group("entries")
+        try:
+            stat = file.stat()
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
         except FileNotFoundError:
-            pass
+            key = None
+
+        if self._index is not None and key == self._key:
+            return self._index
+
+        self._index = {}
+        self._key = key
+
+        if key is None:
+            return self._index
+
+        entries = []
+        lines = None
+
+        with open(file, "r") as f:
+            for line in f:
+                m = re.match(
+                    r"\s*### (?P<marker>BEGIN|END) Boot loader entry for "
+                    r"snapshot (?P<number>\d+) ###", line)
+
+                if m and "BEGIN" == m.group("marker"):
+                    lines = [line.strip()]
+                elif lines is not None:
+                    lines.append(line.rstrip("\n"))
+
+                    if m:
+                        entries.append(
+                            (int(m.group("number")), "\n".join(lines)))
+                        lines = None
+
+        # The newest entry is on top of the configuration file.
+        for number, entry in reversed(entries):
+            self._index[number] = entry
+
+        return self._index
+
+    def _write(self) -> None:
+        file = self._path / "grub-timewarp.cfg"
+
+        if not self._index:
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+
+            self._key = None
+            return
+
+        buffer = "\n\n    ".join(reversed(list(self._index.values())))
+
+        # The configuration file is replaced atomically so that GRUB never
+        # reads a partially written file.
+        fd, temp = tempfile.mkstemp(dir=self._path, prefix=".")
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(f"""submenu 'Snapshots' {{
+    {buffer}
+}}""")
+                f.flush()
+                os.fsync(f.fileno())
+
+            # File systems without Unix permissions such as FAT might refuse
+            # to change the permissions of the temporary file, which does not
+            # matter there.
+            try:
+                os.chmod(temp, 0o644)
+            except OSError:
+                pass
+
+            os.replace(temp, file)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+        stat = file.stat()
+        self._key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _format_entry(
+            self, number: int, entry: timewarp.service.boot.Entry) -> str:
+        lf = "\n"
+        options = []
 
         if entry.options is not None:
             for option in entry.options:
@@ -119,7 +248,7 @@ class GRUB(timewarp.service.boot.Loader):
 
         # I am very sorry for this mess but GRUB configuration files clash
         # badly with Pythons 80 column limit.
-        buffer = f"""    ### BEGIN Boot loader entry for snapshot {number} ###
+        return f"""    ### BEGIN Boot loader entry for snapshot {number} ###
     menuentry '{entry.title}' --class snapshots --class gnu-linux --class gnu \
 --class os $menuentry_id_option \
 'gnulinux-snapshots-{self._root_file_system.uuid}' {{
@@ -141,41 +270,4 @@ class GRUB(timewarp.service.boot.Loader):
     }}
     ### END Boot loader entry for snapshot {number} ###
 
-    """ + buffer
-
-        with open(self._path / "grub-timewarp.cfg", "w") as f:
-            f.write(f"""submenu 'Snapshots' {{
-    {buffer.strip()}
-}}""")
-
-    def remove_entry(self, number: int) -> None:
-        """
-        Removes a GRUB boot loader entry.
-
-        Keyword arguments:
-        number -- the snapshot number
-        """
-        file = self._path / "grub-timewarp.cfg"
-        buffer = ""
-
-        try:
-            with open(file, "r") as f:
-                m = re.search("(?P<entries>###.*###)", f.read(), re.DOTALL)
-
-                if m:
-                    buffer = m.group("entries")
-        except FileNotFoundError:
-            return
-
-        buffer = re.sub(
-            f"### BEGIN Boot loader entry for snapshot {number} ###.*"
-            f"### END Boot loader entry for snapshot {number} ###",
-            "", buffer, flags=re.DOTALL)
-
-        if re.search("### BEGIN", buffer):
-            with open(file, "w") as f:
-                f.write(f"""submenu 'Snapshots' {{
-    {buffer.strip()}
-}}""")
-        else:
-            file.unlink()
+    """
@@ -4,7 +4,11 @@
 # All rights reserved.
 #
 
+import os
 import pathlib
+import re
+import tempfile
+import typing
 
 import timewarp.error
 import timewarp.service.boot
@@ -23,6 +27,9 @@ class SystemDBoot(timewarp.service.boot.Loader):
             raise timewarp.error.InitializationError(
                 f"Directory {self._path} does not exist")
 
+        # Snapshot number: entry files index, see _get_index.
+        self._index = None
+
     def add_entry(
             self, number: int, entry: timewarp.service.boot.Entry) -> None:
         """
@@ -32,6 +39,30 @@ class SystemDBoot(timewarp.service.boot.Loader):
         number -- the snapshot number
         entry  -- the entry to add
         """
+        self.add_entries({number: entry})
+
+    def remove_entry(self, number: int) -> None:
+        """
+        Removes a systemd-boot boot loader entry.
+
+        Keyword arguments:
+        number -- the snapshot number
+        """
+        self.remove_entries([number])
+
+    def _chmod(self, file: str) -> None:
+        # Temporary files are only readable by their owner.  File systems
+        # without Unix permissions such as FAT might refuse the change, which
+        # does not matter there.
+        try:
+            os.chmod(file, 0o644)
+        except OSError:
+            pass
+
+    def _format_entry(
+            self, number: int,
+            entry: timewarp.service.boot.Entry) -> \
+            typing.Tuple[pathlib.Path, str]:
         buffer = []
         width = len(max(vars(entry).keys(), key=len))
 
@@ -72,17 +103,124 @@ class SystemDBoot(timewarp.service.boot.Loader):
         if entry.architecture:
             components.append(entry.architecture)
 
-        filename = self._path / f"{'-'.join(components)}.conf"
+        return self._path / f"{'-'.join(components)}.conf", "\n".join(buffer)
 
-        with open(filename, "w") as f:
-            f.write("\n".join(buffer))
+    def _get_index(self) -> typing.Dict[int, typing.Set[pathlib.Path]]:
+        # Returns a snapshot number: entry files index.  The entries
+        # directory is only scanned once, afterwards the index is kept up to
+        # date as entries are added and removed.
+        if self._index is not None:
+            return self._index
 
-    def remove_entry(self, number: int) -> None:
-        """
-        Removes a systemd-boot boot loader entry.
+        self._index = {}
 
-        Keyword arguments:
-        number -- the snapshot number
-        """
-        for file in self._path.glob(f"zz-{0xFFFFFFFF - number:08x}*.conf"):
+        with os.scandir(self._path) as files:
+            for file in files:
+                m = re.match(
+                    r"zz-(?P<number>[0-9a-f]{8})\b.*\.conf$", file.name)
+
+                if m:
+                    self._index.setdefault(
+                        0xFFFFFFFF - int(m.group("number"), 16), set()).add(
+                            self._path / file.name)
+
+        return self._index
+
+    def _sync(self) -> None:
+        fd = os.open(self._path, os.O_RDONLY | os.O_DIRECTORY)
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _fsync(self, file: pathlib.Path) -> None:
+        fd = os.open(file, os.O_RDONLY)
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _unlink(self, file: pathlib.Path) -> None:
+        try:
             file.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _update(
+            self, entries: typing.Mapping[int, timewarp.service.boot.Entry],
+            numbers: typing.Sequence[int]) -> None:
+        index = self._get_index()
+        temps = {}
+
+        # Each entry is written to a temporary file first and renamed once
+        # all entries have been written, so that neither a failure nor a
+        # crash leaves a truncated entry behind.  The temporary files are
+        # flushed to disk together after all of them have been written.
+        try:
+            for number, entry in sorted(entries.items()):
+                filename, buffer = self._format_entry(number, entry)
+                fd, temp = tempfile.mkstemp(dir=self._path, prefix=".")
+                temps[number] = filename, pathlib.Path(temp)
+
+                with os.fdopen(fd, "w") as f:
+                    f.write(buffer)
+
+                self._chmod(temp)
+
+            for _, temp in temps.values():
+                self._fsync(temp)
+        except BaseException:
+            for _, temp in temps.values():
+                self._unlink(temp)
+
+            raise
+
+        # The entry files which are replaced or removed are moved aside first
+        # so that they can be restored if any rename fails.  The file name
+        # changes with the kernel version, so an existing entry is not
+        # necessarily overwritten.
+        files = {
+            file for number in set(numbers).union(entries)
+            for file in index.get(number, set())}
+        backups = {}
+        installed = []
+
+        try:
+            for file in sorted(files):
+                backup = file.with_name(f".{file.name}.old")
+
+                try:
+                    os.replace(file, backup)
+                    backups[file] = backup
+                except FileNotFoundError:
+                    pass
+
+            for filename, temp in temps.values():
+                os.replace(temp, filename)
+                installed.append(filename)
+        except BaseException:
+            for filename in installed:
+                self._unlink(filename)
+
+            for file, backup in backups.items():
+                os.replace(backup, file)
+
+            for _, temp in temps.values():
+                self._unlink(temp)
+
+            raise
+
+        for backup in backups.values():
+            self._unlink(backup)
+
+        for number in numbers:
+            index.pop(number, None)
+
+        for number, (filename, _) in temps.items():
+            index[number] = {filename}
+
+        # Renames and deletions are made durable for the whole batch at once.
+        if files or temps:
+            self._sync()
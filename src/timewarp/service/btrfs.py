@@ -0,0 +1,229 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import errno
+import fcntl
+import os
+import pathlib
+import sh
+import struct
+import typing
+import uuid
+
+import timewarp.error
+import timewarp.namespace
+
+
+def _ioc(direction: int, number: int, size: int) -> int:
+    # See asm-generic/ioctl.h.  0x94 is the Btrfs ioctl magic number.
+    return direction << 30 | size << 16 | 0x94 << 8 | number
+
+
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+# See linux/btrfs.h.
+_BTRFS_IOC_SNAP_DESTROY = _ioc(_IOC_WRITE, 15, 4096)
+_BTRFS_IOC_WAIT_SYNC = _ioc(_IOC_WRITE, 22, 8)
+_BTRFS_IOC_SNAP_CREATE_V2 = _ioc(_IOC_WRITE, 23, 4096)
+_BTRFS_IOC_START_SYNC = _ioc(_IOC_READ, 24, 8)
+_BTRFS_IOC_GET_SUBVOL_INFO = _ioc(_IOC_READ, 60, 504)
+_BTRFS_SUBVOL_RDONLY = 1 << 1
+
+# struct btrfs_ioctl_vol_args: __s64 fd; char name[4088];
+_VOL_ARGS = struct.Struct("=q4088s")
+
+# struct btrfs_ioctl_vol_args_v2: __s64 fd; __u64 transid; __u64 flags;
+# __u64 unused[4]; char name[4040];
+_VOL_ARGS_V2 = struct.Struct("=qQQ32s4040s")
+
+# struct btrfs_ioctl_get_subvol_info_args: __u64 treeid; char name[256];
+# __u64 parent_id; __u64 dirid; __u64 generation; __u64 flags;
+# __u8 uuid[16]; __u8 parent_uuid[16]; __u8 received_uuid[16];
+# __u64 ctransid; __u64 otransid; __u64 stransid; __u64 rtransid;
+# struct btrfs_ioctl_timespec ctime, otime, stime, rtime; __u64 reserved[8];
+_GET_SUBVOL_INFO_ARGS = struct.Struct("=Q256sQQQQ16s16s16s32x64x64x")
+
+
+class Btrfs(object):
+    """
+    Btrfs subvolume operations.  Uses the Btrfs ioctls directly and falls back
+    on btrfs-progs if the ioctls are not available.
+    """
+
+    def __init__(self) -> None:
+        # The ioctls which are not supported.  Each ioctl falls back on
+        # btrfs-progs on its own as they have been added in different kernel
+        # versions.
+        self._unsupported = set()
+
+    def snapshot(
+            self, source: pathlib.Path, destination: pathlib.Path,
+            read_only: bool = False) -> None:
+        """
+        Creates a snapshot of a subvolume.  Raises SubvolumeError on error.
+
+        Keyword arguments:
+        source      -- the path to the subvolume
+        destination -- the path to the snapshot to create
+        read_only   -- create a read-only instead of a writable snapshot
+                       (default False)
+        """
+        if _BTRFS_IOC_SNAP_CREATE_V2 not in self._unsupported:
+            try:
+                source_fd = os.open(source, os.O_RDONLY | os.O_DIRECTORY)
+
+                try:
+                    self._ioctl(
+                        destination.parent, _BTRFS_IOC_SNAP_CREATE_V2,
+                        bytearray(_VOL_ARGS_V2.pack(
+                            source_fd, 0,
+                            _BTRFS_SUBVOL_RDONLY if read_only else 0, b"",
+                            os.fsencode(destination.name))))
+                finally:
+                    os.close(source_fd)
+
+                return
+            except OSError as e:
+                self._fall_back(_BTRFS_IOC_SNAP_CREATE_V2, e)
+
+        try:
+            if read_only:
+                sh.btrfs.subvolume.snapshot("-r", source, destination)
+            else:
+                sh.btrfs.subvolume.snapshot(source, destination)
+        except sh.CommandNotFound as e:
+            raise timewarp.error.SubvolumeError(f"Command {e} not found")
+        except sh.ErrorReturnCode as e:
+            raise timewarp.error.SubvolumeError(self._reason(e))
+
+    def delete(
+            self, paths: typing.Iterable[pathlib.Path],
+            commit: bool = False) -> None:
+        """
+        Deletes one or more subvolumes.  Raises SubvolumeError on error.
+
+        Keyword arguments:
+        paths  -- the paths to the subvolumes
+        commit -- start committing the transaction after all subvolumes have
+                  been deleted without waiting for the commit to finish
+                  (default False)
+        """
+        paths = list(paths)
+
+        if _BTRFS_IOC_SNAP_DESTROY not in self._unsupported:
+            try:
+                for path in paths:
+                    self._ioctl(
+                        path.parent, _BTRFS_IOC_SNAP_DESTROY,
+                        bytearray(_VOL_ARGS.pack(0, os.fsencode(path.name))))
+
+                if commit and paths:
+                    self.sync(paths[0].parent, False)
+
+                return
+            except OSError as e:
+                self._fall_back(_BTRFS_IOC_SNAP_DESTROY, e)
+
+                # Some subvolumes might have been deleted already.
+                paths = [path for path in paths if path.exists()]
+
+        if not paths:
+            return
+
+        try:
+            if commit:
+                sh.btrfs.subvolume.delete("--commit-after", *paths)
+            else:
+                sh.btrfs.subvolume.delete(*paths)
+        except sh.CommandNotFound as e:
+            raise timewarp.error.SubvolumeError(f"Command {e} not found")
+        except sh.ErrorReturnCode as e:
+            raise timewarp.error.SubvolumeError(self._reason(e))
+
+    def get_subvolume_info(
+            self, path: pathlib.Path) -> timewarp.namespace.Namespace:
+        """
+        Returns the UUID and the generation of a subvolume.  The generation
+        changes whenever the subvolume is modified.  Raises SubvolumeError on
+        error.
+
+        Keyword arguments:
+        path -- the path to the subvolume
+        """
+        if _BTRFS_IOC_GET_SUBVOL_INFO not in self._unsupported:
+            buffer = bytearray(_GET_SUBVOL_INFO_ARGS.size)
+
+            try:
+                self._ioctl(path, _BTRFS_IOC_GET_SUBVOL_INFO, buffer)
+                fields = _GET_SUBVOL_INFO_ARGS.unpack(buffer)
+                return timewarp.namespace.Namespace(
+                    uuid=str(uuid.UUID(bytes=fields[6])),
+                    generation=fields[4])
+            except OSError as e:
+                self._fall_back(_BTRFS_IOC_GET_SUBVOL_INFO, e)
+
+        try:
+            output = sh.btrfs.subvolume.show(path)
+        except sh.CommandNotFound as e:
+            raise timewarp.error.SubvolumeError(f"Command {e} not found")
+        except sh.ErrorReturnCode as e:
+            raise timewarp.error.SubvolumeError(self._reason(e))
+
+        fields = dict(
+            line.strip().split(":", 1) for line in str(output).splitlines()
+            if ":" in line)
+
+        try:
+            return timewarp.namespace.Namespace(
+                uuid=fields["UUID"].strip(),
+                generation=int(fields["Generation"]))
+        except (KeyError, ValueError):
+            raise timewarp.error.SubvolumeError(
+                f"Failed to parse subvolume information of {path}")
+
+    def sync(self, path: pathlib.Path, wait: bool = True) -> None:
+        """
+        Commits the current transaction of the file system containing path.
+        Raises SubvolumeError on error.
+
+        Keyword arguments:
+        path -- a path on the file system
+        wait -- wait for the commit to finish (default True)
+        """
+        buffer = bytearray(8)
+
+        try:
+            self._ioctl(path, _BTRFS_IOC_START_SYNC, buffer)
+
+            if wait:
+                self._ioctl(path, _BTRFS_IOC_WAIT_SYNC, buffer)
+        except OSError as e:
+            raise timewarp.error.SubvolumeError(os.strerror(e.errno))
+
+    def _fall_back(self, request: int, e: OSError) -> None:
+        # ENOTTY and friends mean that the ioctl is not supported, e.g. by an
+        # old kernel.  Any other error is a genuine error.
+        if e.errno in [errno.ENOTTY, errno.ENOSYS, errno.EOPNOTSUPP]:
+            self._unsupported.add(request)
+        else:
+            raise timewarp.error.SubvolumeError(os.strerror(e.errno))
+
+    def _ioctl(
+            self, path: pathlib.Path, request: int,
+            argument: bytearray) -> None:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+        # Immutable arguments are limited to 1024 bytes so we always pass a
+        # mutable buffer.
+        try:
+            fcntl.ioctl(fd, request, argument)
+        finally:
+            os.close(fd)
+
+    def _reason(self, e: sh.ErrorReturnCode) -> str:
+        lines = e.stderr.decode(errors="replace").strip().splitlines()
+        return lines[-1] if lines else f"btrfs exited with code {e.exit_code}"
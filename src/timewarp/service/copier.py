@@ -0,0 +1,164 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import errno
+import fcntl
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import typing
+
+# See linux/fs.h.
+_FICLONE = 0x40049409
+
+
+class Fingerprint(object):
+    """File fingerprint."""
+
+    def __init__(self, size: int, mtime: int, hash: str) -> None:
+        self.size = size
+        self.mtime = mtime
+        self.hash = hash
+
+    def __eq__(self, other: typing.Any) -> bool:
+        return isinstance(other, Fingerprint) and \
+            (self.size, self.hash) == (other.size, other.hash)
+
+
+class Copier(object):
+    """
+    Kernel and initrd image copier.  Copies files using reflinks or in-kernel
+    copying where possible and skips files which are already present.
+    """
+
+    def __init__(self) -> None:
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def copy(self, source: pathlib.Path, destination: pathlib.Path) -> bool:
+        """
+        Copies source to destination unless destination is identical to
+        source already, returning True if the file has been copied.  The
+        destination file is replaced atomically, so an interrupted copy never
+        leaves a truncated file behind.
+
+        Keyword arguments:
+        source      -- the source file
+        destination -- the destination file
+        """
+        fingerprint = self.fingerprint(source)
+
+        try:
+            if self.fingerprint(destination) == fingerprint:
+                return False
+        except FileNotFoundError:
+            pass
+
+        fd, temp = tempfile.mkstemp(dir=destination.parent, prefix=".")
+
+        try:
+            with open(source, "rb") as s, os.fdopen(fd, "wb") as d:
+                self._copy(s.fileno(), d.fileno())
+                os.fsync(d.fileno())
+
+            shutil.copystat(source, temp)
+            os.replace(temp, destination)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+        # We already know the hash of the destination file.
+        stat = destination.stat()
+
+        with self._lock:
+            self._fingerprints[self._key(destination, stat)] = Fingerprint(
+                stat.st_size, stat.st_mtime_ns, fingerprint.hash)
+
+        return True
+
+    def fingerprint(self, path: pathlib.Path) -> Fingerprint:
+        """
+        Returns the fingerprint of a file.  The fingerprint is cached as long
+        as the size and modification time of the file do not change.
+
+        Keyword arguments:
+        path -- the file
+        """
+        stat = path.stat()
+        key = self._key(path, stat)
+
+        with self._lock:
+            fingerprint = self._fingerprints.get(key)
+
+        if fingerprint is None:
+            hash = hashlib.blake2b(digest_size=16)
+
+            with open(path, "rb") as f:
+                for buffer in iter(lambda: f.read(1024 * 1024), b""):
+                    hash.update(buffer)
+
+            fingerprint = Fingerprint(
+                stat.st_size, stat.st_mtime_ns, hash.hexdigest())
+
+            with self._lock:
+                self._fingerprints[key] = fingerprint
+
+        return fingerprint
+
+    def _copy(self, source: int, destination: int) -> None:
+        # Try to share the data extents first (Btrfs, XFS).
+        try:
+            fcntl.ioctl(destination, _FICLONE, source)
+            return
+        except OSError:
+            pass
+
+        size = os.fstat(source).st_size
+        offset = 0
+
+        # Let the kernel copy the data, avoiding copies to user space.
+        # copy_file_range is available as of Python 3.8 and might not support
+        # copying across file systems.
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < size:
+                    count = os.copy_file_range(
+                        source, destination, size - offset)
+
+                    if not count:
+                        break
+
+                    offset += count
+            except OSError as e:
+                if e.errno not in [
+                        errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+                        errno.EINVAL] or offset:
+                    raise
+
+        try:
+            while offset < size:
+                count = os.sendfile(destination, source, offset, size - offset)
+
+                if not count:
+                    break
+
+                offset += count
+        except OSError as e:
+            if e.errno not in [errno.ENOSYS, errno.EINVAL] or offset:
+                raise
+
+            # Fall back on copying in user space.
+            with os.fdopen(source, "rb", closefd=False) as s, \
+                    os.fdopen(destination, "wb", closefd=False) as d:
+                shutil.copyfileobj(s, d, 1024 * 1024)
+
+    def _key(
+            self, path: pathlib.Path,
+            stat: os.stat_result) -> typing.Tuple[str, int, int, int]:
+        return str(path), stat.st_ino, stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,154 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import collections
+import enum
+import queue
+import threading
+import typing
+import uuid
+
+
+class JobState(enum.Enum):
+    """Job state."""
+
+    PENDING = 0
+    RUNNING = 1
+    COMPLETED = 2
+    FAILED = 3
+    CANCELLED = 4
+
+    def __str__(self) -> str:
+        return self.name.lower()
+
+
+class Job(object):
+    """Asynchronous job."""
+
+    def __init__(
+            self, function: typing.Callable[..., int],
+            args: typing.Sequence[typing.Any]) -> None:
+        self.id = uuid.uuid4().hex
+        self.state = JobState.PENDING
+        self.progress = 0.0
+        self.stage = ""
+        self.number = 0
+        self._function = function
+        self._args = args
+        self._progress_handler = None
+
+    def set_progress(self, progress: float, stage: str) -> None:
+        """
+        Updates the job progress.
+
+        Keyword arguments:
+        progress -- the progress, ranging from 0.0 to 1.0
+        stage    -- the name of the current stage
+        """
+        self.progress = progress
+        self.stage = stage
+
+        if self._progress_handler is not None:
+            self._progress_handler(self)
+
+
+class JobQueue(object):
+    """Job queue which runs jobs one after another on a worker thread."""
+
+    # The number of finished jobs kept for polling.
+    _history = 64
+
+    def __init__(
+            self, progress_handler: typing.Callable[[Job], None],
+            completion_handler: typing.Callable[[Job], None]) -> None:
+        self._progress_handler = progress_handler
+        self._completion_handler = completion_handler
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+            self, function: typing.Callable[..., int],
+            *args: typing.Any) -> Job:
+        """
+        Submits a new job, returning the job.  The function has to accept the
+        job as keyword argument and return the snapshot number or 0 on error.
+
+        Keyword arguments:
+        function -- the function to run
+        args     -- the function arguments
+        """
+        job = Job(function, args)
+        job._progress_handler = self._progress_handler
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._expire()
+
+        self._queue.put(job)
+        return job
+
+    def get(self, id: str) -> typing.Optional[Job]:
+        """
+        Returns the job identified by id or None if there is no such job.
+
+        Keyword arguments:
+        id -- the job ID
+        """
+        with self._lock:
+            return self._jobs.get(id)
+
+    def cancel(self, id: str) -> bool:
+        """
+        Cancels a pending job, returning True on success.  Jobs which are
+        already running cannot be cancelled.
+
+        Keyword arguments:
+        id -- the job ID
+        """
+        with self._lock:
+            job = self._jobs.get(id)
+
+            if job is None or JobState.PENDING != job.state:
+                return False
+
+            job.state = JobState.CANCELLED
+
+        self._completion_handler(job)
+        return True
+
+    def _expire(self) -> None:
+        # Forget about the oldest finished jobs.
+        finished = [
+            job.id for job in self._jobs.values()
+            if job.state not in [JobState.PENDING, JobState.RUNNING]]
+
+        for id in finished[:max(0, len(finished) - JobQueue._history)]:
+            del self._jobs[id]
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+
+            with self._lock:
+                if JobState.PENDING != job.state:
+                    continue
+
+                job.state = JobState.RUNNING
+
+            try:
+                job.number = job._function(*job._args, job=job)
+            except Exception:
+                job.number = 0
+
+            with self._lock:
+                job.state = JobState.COMPLETED if job.number \
+                    else JobState.FAILED
+
+            self._completion_handler(job)
@@ -0,0 +1,149 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import typing
+
+import timewarp.error
+
+
+class Journal(object):
+    """
+    Append-only intent journal.  Each stage of a boot environment creation is
+    recorded before it is run so that interrupted creations can be resumed.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._operations = {}
+
+        # Read the operations which have not been completed yet.  A truncated
+        # last record is ignored, as the stage it announces has never been
+        # started.
+        try:
+            with open(self._path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+
+                    self._apply(record)
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, TypeError) as e:
+            raise timewarp.error.InitializationError(
+                f"Invalid journal {self._path}: {e}")
+
+        # Rewrite the journal so that it only contains the pending operations
+        # and does not end with a truncated record.  The journal is replaced
+        # atomically so that the pending operations survive a crash in the
+        # meantime.
+        try:
+            fd, temp = tempfile.mkstemp(dir=self._path.parent, prefix=".")
+
+            try:
+                with os.fdopen(fd, "w") as f:
+                    for number, operation in self._operations.items():
+                        f.write(json.dumps(
+                            {**operation, "stage": "begin"}) + "\n")
+
+                        if "begin" != operation["stage"]:
+                            f.write(json.dumps({
+                                "number": number,
+                                "stage": operation["stage"]}) + "\n")
+
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                os.replace(temp, self._path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+
+            self._file = open(self._path, "a")
+        except OSError as e:
+            raise timewarp.error.InitializationError(
+                f"Failed to rewrite journal {self._path}: {e}")
+
+    def begin(
+            self, number: int,
+            data: typing.Mapping[str, typing.Any]) -> None:
+        """
+        Records the start of a new operation.
+
+        Keyword arguments:
+        number -- the snapshot number
+        data   -- the data needed to resume the operation
+        """
+        self._append({**data, "number": number, "stage": "begin"})
+
+    def record(self, number: int, stage: str) -> None:
+        """
+        Records the start of an operation stage.
+
+        Keyword arguments:
+        number -- the snapshot number
+        stage  -- the stage name
+        """
+        self._append({"number": number, "stage": stage})
+
+    def complete(self, number: int) -> None:
+        """
+        Records the completion of an operation.
+
+        Keyword arguments:
+        number -- the snapshot number
+        """
+        self._append({"number": number, "stage": "done"})
+
+    def fail(self, number: int) -> None:
+        """
+        Records the failure of an operation, which is not resumed either.
+
+        Keyword arguments:
+        number -- the snapshot number
+        """
+        self._append({"number": number, "stage": "failed"})
+
+    def pending(self) -> typing.Mapping[int, typing.Mapping[str, typing.Any]]:
+        """
+        Returns the operations which have not been completed yet.  Each
+        operation contains the data passed to begin and the last stage which
+        has been started.
+        """
+        with self._lock:
+            return dict(self._operations)
+
+    def _append(self, record: typing.Mapping[str, typing.Any]) -> None:
+        with self._lock:
+            self._apply(record)
+
+            # There is nothing left to resume, start over with an empty
+            # journal so that it does not grow indefinitely.
+            if not self._operations:
+                self._file.truncate(0)
+                self._file.seek(0)
+            else:
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+
+            os.fdatasync(self._file.fileno())
+
+    def _apply(self, record: typing.Mapping[str, typing.Any]) -> None:
+        number = record["number"]
+
+        if "begin" == record["stage"]:
+            self._operations[number] = dict(record)
+        elif record["stage"] in ["done", "failed"]:
+            self._operations.pop(number, None)
+        elif number in self._operations:
+            self._operations[number]["stage"] = record["stage"]
@@ -0,0 +1,111 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import bisect
+import contextlib
+import threading
+import time
+import typing
+
+# Bucket upper bounds in seconds, growing by a factor of 2^(1/4) from 1µs to
+# roughly 20 minutes.  Percentiles are thus accurate to about 19%.
+_BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(121)]
+
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._buckets = [0] * (len(_BOUNDS) + 1)
+
+    def add(self, value: float) -> None:
+        """
+        Adds a sample.
+
+        Keyword arguments:
+        value -- the latency in seconds
+        """
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self._buckets[bisect.bisect_left(_BOUNDS, value)] += 1
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Returns an estimate of a percentile in seconds, 0.0 if there are no
+        samples.
+
+        Keyword arguments:
+        percentile -- the percentile between 0 and 100
+        """
+        rank = self.count * percentile / 100
+        total = 0
+
+        for i, count in enumerate(self._buckets):
+            total += count
+
+            if count and total >= rank:
+                return min(_BOUNDS[i], self.max) \
+                    if i < len(_BOUNDS) else self.max
+
+        return 0.0
+
+
+class Metrics(object):
+    """Per-stage latency histograms."""
+
+    def __init__(self) -> None:
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, value: float) -> None:
+        """
+        Adds a sample to a histogram.
+
+        Keyword arguments:
+        name  -- the histogram name
+        value -- the latency in seconds
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+
+            histogram.add(value)
+
+    @contextlib.contextmanager
+    def measure(self, name: str) -> typing.Iterator[None]:
+        """
+        Context manager measuring the latency of its body.  Failed stages are
+        measured as well.
+
+        Keyword arguments:
+        name -- the histogram name
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def get(self) -> typing.Mapping[
+            str, typing.Tuple[int, float, float, float, float]]:
+        """
+        Returns a name: (count, sum, p50, p95, p99) mapping for all
+        histograms.  Latencies are in seconds.
+        """
+        with self._lock:
+            return {
+                name: (
+                    histogram.count, histogram.sum,
+                    histogram.percentile(50), histogram.percentile(95),
+                    histogram.percentile(99))
+                for name, histogram in self._histograms.items()}
@@ -4,9 +4,14 @@
 # All rights reserved.
 #
 
+import collections
+import os
 import pathlib
+import threading
 import typing
 
+import timewarp.error
+
 
 class Package(object):
     """Package."""
@@ -19,6 +24,13 @@ class Package(object):
 class Database(object):
     """Package database."""
 
+    # Path: (inode and modification time, index) mapping shared by all
+    # package databases.  Only the most recently used indexes are kept as
+    # there is a package database per boot environment.
+    _cache = collections.OrderedDict()
+    _cache_size = 64
+    _lock = threading.Lock()
+
     def __init__(self, root: pathlib.Path) -> None:
         if type(self) is Database:
             raise NotImplementedError
@@ -32,3 +44,52 @@ class Database(object):
         name -- the package name
         """
         raise NotImplementedError
+
+    def get_packages_by_names(
+            self, names: typing.Iterable[str]) -> \
+            typing.Mapping[str, typing.Sequence[Package]]:
+        """
+        Returns all packages identified by any of the names as a name:
+        packages mapping.  Names without packages are left out.  Package
+        databases which are able to look up several names in a single pass
+        should override this method.
+
+        Keyword arguments:
+        names -- the package names
+        """
+        result = {}
+
+        for name in names:
+            try:
+                result[name] = self.get_packages_by_name(name)
+            except timewarp.error.PackageNotFoundError:
+                pass
+
+        return result
+
+    def _get_index(self, path: pathlib.Path) -> typing.Any:
+        # Returns the index read by _read_index, which is cached until the
+        # inode or the modification time of the path changes.  Raises
+        # FileNotFoundError if the path does not exist.
+        stat = os.stat(path)
+        key = str(path)
+        mtime = (stat.st_ino, stat.st_mtime_ns)
+
+        with self._lock:
+            if key in self._cache and self._cache[key][0] == mtime:
+                self._cache.move_to_end(key)
+                return self._cache[key][1]
+
+        index = self._read_index(path)
+
+        with self._lock:
+            self._cache[key] = mtime, index
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return index
+
+    def _read_index(self, path: pathlib.Path) -> typing.Any:
+        raise NotImplementedError
@@ -4,8 +4,8 @@
 # All rights reserved.
 #
 
+import os
 import pathlib
-import re
 import typing
 
 import timewarp.error
@@ -35,22 +35,114 @@ class ALPM(timewarp.service.package.Database):
         Keyword arguments:
         name -- the package name
         """
-        result = []
+        result = self.get_packages_by_names([name])
 
-        for desc in self._path.glob(f"{name}-*/desc"):
-            with open(desc, "r") as f:
-                buffer = f.read()
+        if name in result:
+            return result[name]
 
-            if re.search(fr"%NAME%\s+{name}\s+", buffer):
-                m = re.search(r"%VERSION%\s+(?P<version>.*)\s+", buffer)
+        raise timewarp.error.PackageNotFoundError
+
+    def get_packages_by_names(
+            self, names: typing.Iterable[str]) -> \
+            typing.Mapping[
+                str, typing.Sequence[timewarp.service.package.Package]]:
+        """
+        Returns all packages identified by any of the names as a name:
+        packages mapping.  Names without packages are left out.  Raises
+        InvalidPackageInformationError if the package data could not be
+        processed properly.
+
+        Keyword arguments:
+        names -- the package names
+        """
+        # Installing, upgrading or removing a package adds or removes a
+        # package directory, which changes the modification time of the
+        # local database directory.
+        try:
+            index = self._get_index(self._path)
+        except FileNotFoundError:
+            raise timewarp.error.InitializationError(
+                f"Local ALPM package database {self._path} does not exist")
+
+        result = {}
+
+        for name in names:
+            packages = []
+
+            # The package description is authoritative, but only those of the
+            # matching entries are read, once per cached index.  The contents
+            # of a package directory do not change as upgrading a package
+            # replaces the directory.
+            descs = index.get(name, {})
+
+            for path, desc in descs.items():
+                if desc is None:
+                    try:
+                        desc = descs[path] = self._read_desc(path / "desc")
+                    except FileNotFoundError:
+                        continue
+
+                desc_name, version = desc
 
-                if m:
-                    result.append(timewarp.service.package.Package(
-                        name, m.group("version")))
-                else:
+                if desc_name != name:
+                    continue
+
+                if version is None:
                     raise timewarp.error.InvalidPackageInformationError
 
-        if result:
-            return result
+                packages.append(
+                    timewarp.service.package.Package(name, version))
 
-        raise timewarp.error.PackageNotFoundError
+            if packages:
+                result[name] = packages
+
+        return result
+
+    def _read_index(
+            self, path: pathlib.Path) -> typing.Mapping[
+                str, typing.Dict[pathlib.Path, typing.Optional[typing.Tuple[
+                    typing.Optional[str], typing.Optional[str]]]]]:
+        # Returns a package name: package directory: (name, version) mapping
+        # built from the package directory names, which are of the form
+        # name-pkgver-pkgrel, in a single directory scan.  The name and the
+        # version are None until the package description has been read.
+        index = {}
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                parts = entry.name.rsplit("-", 2)
+
+                if len(parts) != 3 or not entry.is_dir():
+                    continue
+
+                index.setdefault(parts[0], {})[pathlib.Path(entry.path)] = None
+
+        return index
+
+    def _read_desc(
+            self, desc: pathlib.Path) -> \
+            typing.Tuple[typing.Optional[str], typing.Optional[str]]:
+        # Only the %NAME% and %VERSION% sections are read, which come first in
+        # the package description.
+        name = None
+        version = None
+
+        with open(desc, "r") as f:
+            section = None
+
+            for line in f:
+                line = line.strip()
+
+                if line.startswith("%") and line.endswith("%"):
+                    section = line
+                elif not line:
+                    section = None
+                elif "%NAME%" == section:
+                    name = line
+                elif "%VERSION%" == section:
+                    version = line
+
+                if name is not None and version is not None:
+                    break
+
+        return name, version
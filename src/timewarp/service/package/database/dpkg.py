@@ -4,6 +4,7 @@
 # All rights reserved.
 #
 
+import mmap
 import pathlib
 import re
 import typing
@@ -15,6 +16,20 @@ import timewarp.service.package
 class Dpkg(timewarp.service.package.Database):
     """Debian Package Manager database."""
 
+    # Stanzas of the status file, which dpkg writes with the Package, Status
+    # and Version fields in this order.  The fields in between are skipped
+    # up to the empty line ending the stanza, see deb-control(5).
+    _stanza = re.compile(
+        rb"Package: (?P<package>[^\n]*)\n"
+        rb"(?:[^\n]+\n)*?"
+        rb"Status: (?P<status>[^\n]*)\n"
+        rb"(?:[^\n]+\n)*?"
+        rb"Version: (?P<version>[^\n]*)")
+
+    # Versioned package name suffixes such as -5.10.0-8 of
+    # linux-image-5.10.0-8.
+    _suffix = re.compile(r"-(?=\d[\w\-\.]+$)")
+
     def __init__(self, root: pathlib.Path) -> None:
         super().__init__(root)
         self._path = root / "var" / "lib" / "dpkg"
@@ -33,21 +48,69 @@ class Dpkg(timewarp.service.package.Database):
         Keyword arguments:
         name -- the package name
         """
-        result = []
+        result = self.get_packages_by_names([name])
 
-        with open(self._path / "status", "r") as f:
-            buffer = f.read()
+        if name in result:
+            return result[name]
+
+        raise timewarp.error.PackageNotFoundError
 
-        for m in re.finditer(
-                fr"Package: (?P<name>{name}(-\d[\w\-\.]+)?)\s+"
-                fr"Status: (?P<status>[\w ]+)\s+"
-                fr".*?"
-                fr"Version: (?P<version>[\w\-\.]+)\s+", buffer, re.DOTALL):
-            if "installed" in m.group("status").split(" "):
-                result.append(timewarp.service.package.Package(
-                    m.group("name"), m.group("version")))
+    def get_packages_by_names(
+            self, names: typing.Iterable[str]) -> \
+            typing.Mapping[
+                str, typing.Sequence[timewarp.service.package.Package]]:
+        """
+        Returns all packages identified by any of the names as a name:
+        packages mapping.  Names without packages are left out.
 
-        if result:
-            return result
+        Keyword arguments:
+        names -- the package names
+        """
+        # dpkg replaces the status file on each update, so the inode and the
+        # modification time identify its contents.
+        index = self._get_index(self._path / "status")
+        result = {}
 
-        raise timewarp.error.PackageNotFoundError
+        for name in names:
+            if name in index:
+                result[name] = [
+                    timewarp.service.package.Package(package, version)
+                    for package, version in index[name]]
+
+        return result
+
+    def _read_index(
+            self, path: pathlib.Path) -> \
+            typing.Mapping[str, typing.List[typing.Tuple[str, str]]]:
+        # Returns a name: (package, version) mapping of the installed
+        # packages, where the name is either the package name or the package
+        # name without a version suffix.  The stanzas are found in a single
+        # pass over the status file.
+        index = {}
+
+        with open(path, "rb") as f:
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # The status file is empty.
+                return index
+
+        with buffer:
+            for m in self._stanza.finditer(buffer):
+                # Skip matches which do not start at the beginning of a line,
+                # e.g. within a multi-line field.
+                if m.start() > 0 and buffer[m.start() - 1] != ord("\n"):
+                    continue
+
+                if b"installed" not in m.group("status").split():
+                    continue
+
+                package = m.group("package").strip().decode()
+                version = m.group("version").strip().decode()
+                index.setdefault(package, []).append((package, version))
+
+                for suffix in self._suffix.finditer(package):
+                    index.setdefault(package[:suffix.start()], []).append(
+                        (package, version))
+
+        return index
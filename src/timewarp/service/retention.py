@@ -0,0 +1,68 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import typing
+
+
+class Policy(object):
+    """
+    Boot environment retention policy.  A boot environment is kept if any of
+    the configured rules applies to it.
+    """
+
+    def __init__(
+            self, last: int = None, last_per_kernel: int = None,
+            important: bool = True) -> None:
+        self.last = last
+        self.last_per_kernel = last_per_kernel
+        self.important = important
+
+    @property
+    def enabled(self) -> bool:
+        """True if any boot environment might be pruned."""
+        return self.last is not None or self.last_per_kernel is not None
+
+    def select(
+            self, kernels: typing.Mapping[int, typing.Optional[str]],
+            userdata: typing.Mapping[
+                int, typing.Optional[typing.Mapping[str, str]]]) -> \
+            typing.Set[int]:
+        """
+        Returns the snapshot numbers of the boot environments to be pruned.
+
+        Keyword arguments:
+        kernels  -- a snapshot number: kernel version mapping, the kernel
+                    version is None if it is unknown
+        userdata -- a snapshot number: snapshot userdata mapping, the userdata
+                    is None if it is unknown
+        """
+        if not self.enabled:
+            return set()
+
+        numbers = sorted(kernels, reverse=True)
+        keep = set()
+
+        if self.last is not None:
+            keep.update(numbers[:self.last])
+
+        if self.last_per_kernel is not None:
+            versions = {}
+
+            for number in numbers:
+                versions.setdefault(kernels[number], []).append(number)
+
+            for numbers_ in versions.values():
+                keep.update(numbers_[:self.last_per_kernel])
+
+        # Boot environments whose userdata is unknown are kept as they might
+        # be important.
+        if self.important:
+            keep.update(
+                number for number in numbers
+                if userdata.get(number) is None or
+                userdata[number].get("important") == "yes")
+
+        return set(numbers) - keep
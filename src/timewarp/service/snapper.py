@@ -33,50 +33,63 @@ class Snapshot(object):
 class Snapper(object):
     """Wrapper around the Snapper D-Bus service."""
 
-    def __init__(self, name: str, cleanup_algorithm: str) -> None:
+    def __init__(
+            self, name: str, cleanup_algorithm: str,
+            bus: pydbus.bus.Bus = None) -> None:
         self._name = name
         self._cleanup_algorithm = cleanup_algorithm
-        self._pre_number = None
 
-        # Connect to the Snapper D-Bus service.
+        # Pre-snapshot numbers are kept per session so that concurrent
+        # sessions can create pre- and post-snapshots independently.
+        self._pre_numbers = {}
+
+        # Connect to the Snapper D-Bus service, by default on the system bus.
         try:
-            self._service = pydbus.SystemBus().get("org.opensuse.Snapper")
+            self._service = (
+                bus if bus is not None else pydbus.SystemBus()).get(
+                "org.opensuse.Snapper")
         except GLib.Error:
             raise timewarp.error.InitializationError(
                 "snapperd is not running")
 
     def create_pre_snapshot(
-            self, description: str,
-            userdata: typing.Mapping[str, str]) -> Snapshot:
+            self, description: str, userdata: typing.Mapping[str, str],
+            session: str = "") -> Snapshot:
         """
-        Creates a new pre-snapshot, returning the snapshot.
+        Creates a new pre-snapshot, returning the snapshot.  If the session
+        has created a pre-snapshot without post-snapshot before, this
+        pre-snapshot is returned instead.
 
         Keyword arguments:
         description -- the snapshot description
         userdata    -- a dictionary containing optional user data
+        session     -- the session token (default "")
         """
-        if not self._pre_number:
-            self._pre_number = self._service.CreatePreSnapshot(
+        if session not in self._pre_numbers:
+            self._pre_numbers[session] = self._service.CreatePreSnapshot(
                 self._name, description, self._cleanup_algorithm, userdata)
 
-        return self._get_snapshot(self._pre_number)
+        return self.get_snapshot(self._pre_numbers[session])
 
     def create_post_snapshot(
-            self, description: str,
-            userdata: typing.Mapping[str, str]) -> Snapshot:
+            self, description: str, userdata: typing.Mapping[str, str],
+            session: str = "") -> Snapshot:
         """
-        Creates a new post-snapshot, returning the snapshot.
+        Creates a new post-snapshot for the pre-snapshot of the session,
+        returning the snapshot.  Raises NoPreSnapshotError if the session has
+        not created a pre-snapshot.
 
         Keyword arguments:
         description -- the snapshot description
         userdata    -- a dictionary containing optional user data
+        session     -- the session token (default "")
         """
-        if self._pre_number:
+        if session in self._pre_numbers:
             post_number = self._service.CreatePostSnapshot(
-                self._name, self._pre_number, description,
+                self._name, self._pre_numbers[session], description,
                 self._cleanup_algorithm, userdata)
-            self._pre_number = None
-            return self._get_snapshot(post_number)
+            del self._pre_numbers[session]
+            return self.get_snapshot(post_number)
         else:
             raise timewarp.error.NoPreSnapshotError
 
@@ -92,9 +105,15 @@ class Snapper(object):
         """
         number = self._service.CreateSingleSnapshot(
             self._name, description, self._cleanup_algorithm, userdata)
-        return self._get_snapshot(number)
+        return self.get_snapshot(number)
+
+    def get_snapshot(self, number: int) -> Snapshot:
+        """
+        Returns an existing snapshot.
 
-    def _get_snapshot(self, number: int) -> Snapshot:
+        Keyword arguments:
+        number -- the snapshot number
+        """
         return Snapshot(*self._service.GetSnapshot(self._name, number))
 
 
@@ -0,0 +1,265 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import json
+import pathlib
+import sqlite3
+import threading
+import typing
+
+import timewarp.error
+import timewarp.service.package
+
+
+class State(object):
+    """
+    Persistent state index, mapping snapshot numbers to boot environments,
+    kernel packages, snapshot userdata, copied kernel and initrd images and
+    boot loader entries.  Additionally caches the kernel packages of
+    subvolumes by subvolume UUID and generation.
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS bootenvs (
+            number INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            kernel_name TEXT,
+            kernel_version TEXT,
+            entry TEXT,
+            userdata TEXT
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            number INTEGER NOT NULL REFERENCES bootenvs (number)
+                ON DELETE CASCADE,
+            path TEXT NOT NULL,
+            PRIMARY KEY (number, path)
+        );
+        CREATE TABLE IF NOT EXISTS packages (
+            uuid TEXT PRIMARY KEY,
+            number INTEGER NOT NULL,
+            generation INTEGER NOT NULL,
+            query TEXT NOT NULL,
+            kernel_name TEXT NOT NULL,
+            kernel_version TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS packages_number ON packages (number);
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        file = path / "state.db"
+        self._lock = threading.Lock()
+
+        try:
+            path.mkdir(parents=True, exist_ok=True)
+            self.created = not file.exists()
+
+            # The connection is shared between threads, access is serialized
+            # using the lock.
+            self._connection = sqlite3.connect(
+                str(file), check_same_thread=False)
+            self._connection.execute("PRAGMA foreign_keys = ON")
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.executescript(State._schema)
+
+            # State indexes created by earlier versions lack the userdata
+            # column.
+            if "userdata" not in [
+                    row[1] for row in self._connection.execute(
+                        "PRAGMA table_info(bootenvs)")]:
+                self._connection.execute(
+                    "ALTER TABLE bootenvs ADD COLUMN userdata TEXT")
+        except (OSError, sqlite3.Error) as e:
+            raise timewarp.error.InitializationError(
+                f"Failed to open state database {file}: {e}")
+
+    def add_boot_environment(
+            self, number: int, path: pathlib.Path,
+            package: typing.Optional[timewarp.service.package.Package],
+            files: typing.Iterable[pathlib.Path] = (),
+            entry: typing.Mapping[str, typing.Any] = None,
+            userdata: typing.Mapping[str, str] = None) -> None:
+        """
+        Adds or replaces a boot environment.
+
+        Keyword arguments:
+        number   -- the snapshot number
+        path     -- the path to the boot environment
+        package  -- the kernel package or None if unknown
+        files    -- the kernel and initrd images used by the boot environment
+        entry    -- the boot loader entry
+        userdata -- the snapshot userdata or None if unknown
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO bootenvs VALUES (?, ?, ?, ?, ?, ?)", (
+                    number, str(path),
+                    package.name if package is not None else None,
+                    package.version if package is not None else None,
+                    json.dumps(entry) if entry is not None else None,
+                    json.dumps(userdata) if userdata is not None else None))
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO files VALUES (?, ?)",
+                [(number, str(file)) for file in files])
+
+    def get_boot_environments(self) -> typing.Mapping[
+            int, typing.Optional[timewarp.service.package.Package]]:
+        """
+        Returns a snapshot number: kernel package mapping for all boot
+        environments.  The kernel package is None if it is unknown.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT number, kernel_name, kernel_version "
+                "FROM bootenvs").fetchall()
+
+        return {
+            number: timewarp.service.package.Package(name, version)
+            if version is not None else None
+            for number, name, version in rows}
+
+    def get_files(self, number: int) -> typing.Sequence[pathlib.Path]:
+        """
+        Returns the kernel and initrd images used by a boot environment.
+
+        Keyword arguments:
+        number -- the snapshot number
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path FROM files WHERE number = ?",
+                (number,)).fetchall()
+
+        return [pathlib.Path(path) for path, in rows]
+
+    def get_used_files(
+            self, files: typing.Iterable[pathlib.Path]) -> \
+            typing.Set[pathlib.Path]:
+        """
+        Returns the kernel and initrd images which are used by any boot
+        environment.
+
+        Keyword arguments:
+        files -- the kernel and initrd images to look up
+        """
+        files = [str(file) for file in files]
+
+        if not files:
+            return set()
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT DISTINCT path FROM files WHERE path IN "
+                f"({', '.join('?' * len(files))})", files).fetchall()
+
+        return {pathlib.Path(path) for path, in rows}
+
+    def get_package(
+            self, uuid: str, generation: int, name: str) -> \
+            typing.Optional[timewarp.service.package.Package]:
+        """
+        Returns the cached kernel package of a subvolume or None if it is not
+        cached or the subvolume has been modified since.
+
+        Keyword arguments:
+        uuid       -- the subvolume UUID
+        generation -- the subvolume generation
+        name       -- the kernel package name queried
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT kernel_name, kernel_version FROM packages "
+                "WHERE uuid = ? AND generation = ? AND query = ?",
+                (uuid, generation, name)).fetchone()
+
+        return timewarp.service.package.Package(*row) \
+            if row is not None else None
+
+    def set_package(
+            self, uuid: str, number: int, generation: int, name: str,
+            package: timewarp.service.package.Package) -> None:
+        """
+        Caches the kernel package of a subvolume.
+
+        Keyword arguments:
+        uuid       -- the subvolume UUID
+        number     -- the snapshot number the subvolume belongs to
+        generation -- the subvolume generation
+        name       -- the kernel package name queried
+        package    -- the kernel package
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?)",
+                (uuid, number, generation, name, package.name,
+                    package.version))
+
+    def get_userdata(self) -> typing.Mapping[
+            int, typing.Optional[typing.Mapping[str, str]]]:
+        """
+        Returns a snapshot number: snapshot userdata mapping for all boot
+        environments.  The userdata is None if it is unknown.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT number, userdata FROM bootenvs").fetchall()
+
+        return {
+            number: json.loads(userdata) if userdata is not None else None
+            for number, userdata in rows}
+
+    def set_userdata(
+            self, number: int, userdata: typing.Mapping[str, str]) -> None:
+        """
+        Sets the snapshot userdata of a boot environment.
+
+        Keyword arguments:
+        number   -- the snapshot number
+        userdata -- the snapshot userdata
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE bootenvs SET userdata = ? WHERE number = ?",
+                (json.dumps(userdata), number))
+
+    def set_kernel(
+            self, number: int, path: pathlib.Path,
+            package: typing.Optional[timewarp.service.package.Package]) -> \
+            None:
+        """
+        Sets the kernel package of a boot environment, adding the boot
+        environment if necessary.
+
+        Keyword arguments:
+        number  -- the snapshot number
+        path    -- the path to the boot environment
+        package -- the kernel package or None if unknown
+        """
+        name = package.name if package is not None else None
+        version = package.version if package is not None else None
+
+        with self._lock, self._connection:
+            if not self._connection.execute(
+                    "UPDATE bootenvs SET kernel_name = ?, kernel_version = ? "
+                    "WHERE number = ?", (name, version, number)).rowcount:
+                self._connection.execute(
+                    "INSERT INTO bootenvs VALUES (?, ?, ?, ?, NULL, NULL)",
+                    (number, str(path), name, version))
+
+    def remove_boot_environments(self, numbers: typing.Iterable[int]) -> None:
+        """
+        Removes boot environments and the cached kernel packages of their
+        subvolumes.
+
+        Keyword arguments:
+        numbers -- the snapshot numbers
+        """
+        numbers = [(number,) for number in numbers]
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM bootenvs WHERE number = ?", numbers)
+            self._connection.executemany(
+                "DELETE FROM packages WHERE number = ?", numbers)
@@ -0,0 +1,144 @@
+#
+# Time Warp
+# Copyright 2020, 2021 Thomas Müller
+# All rights reserved.
+#
+
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+
+import timewarp.error
+import timewarp.service.copier
+
+
+class Store(object):
+    """
+    Content-addressed kernel and initrd image store.  Images are stored under
+    their SHA-256 hash, together with the snapshot numbers referencing them.
+    """
+
+    def __init__(
+            self, path: pathlib.Path,
+            copier: timewarp.service.copier.Copier = None) -> None:
+        self.path = path
+        self._copier = copier if copier is not None \
+            else timewarp.service.copier.Copier()
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._references = {}
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            raise timewarp.error.InitializationError(
+                f"Unable to create image store {self.path}: {e.strerror}")
+
+        try:
+            with open(self.path / "references.json", "r") as f:
+                self._references = {
+                    hash: set(numbers)
+                    for hash, numbers in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            raise timewarp.error.InitializationError(
+                f"Invalid image store reference file "
+                f"{self.path / 'references.json'}")
+
+    def add(self, source: pathlib.Path, number: int) -> pathlib.Path:
+        """
+        Adds an image to the store and references it by the snapshot number,
+        returning the path to the stored image.  The image is only copied if
+        the store does not contain an identical image yet.
+
+        Keyword arguments:
+        source -- the path to the image
+        number -- the snapshot number
+        """
+        hash = self._hash(source)
+        file = self.path / hash
+
+        with self._lock:
+            if not file.exists():
+                self._copier.copy(source, file)
+
+            self._references.setdefault(hash, set()).add(number)
+            self._save()
+
+        return file
+
+    def release(self, number: int) -> bool:
+        """
+        Drops all references of the snapshot number and deletes images which
+        are not referenced anymore.  Returns False if the snapshot number did
+        not reference any image.
+
+        Keyword arguments:
+        number -- the snapshot number
+        """
+        with self._lock:
+            unused = []
+            found = False
+
+            for hash, numbers in self._references.items():
+                if number in numbers:
+                    numbers.discard(number)
+                    found = True
+
+                    if not numbers:
+                        unused.append(hash)
+
+            if not found:
+                return False
+
+            for hash in unused:
+                del self._references[hash]
+
+            # Save the references first so that a crash leaves unreferenced
+            # images behind rather than references to deleted images.
+            self._save()
+
+            for hash in unused:
+                try:
+                    (self.path / hash).unlink()
+                except FileNotFoundError:
+                    pass
+
+        return True
+
+    def _hash(self, source: pathlib.Path) -> str:
+        # Hashing is expensive so we are caching the hash as long as the size
+        # and modification time of the image do not change.
+        stat = source.stat()
+        key = (str(source), stat.st_size, stat.st_mtime_ns)
+
+        if key not in self._hashes:
+            hash = hashlib.sha256()
+
+            with open(source, "rb") as f:
+                for buffer in iter(lambda: f.read(1024 * 1024), b""):
+                    hash.update(buffer)
+
+            self._hashes[key] = hash.hexdigest()
+
+        return self._hashes[key]
+
+    def _save(self) -> None:
+        fd, temp = tempfile.mkstemp(dir=self.path, prefix=".")
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    hash: sorted(numbers)
+                    for hash, numbers in self._references.items()}, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(temp, self.path / "references.json")
+        except BaseException:
+            os.unlink(temp)
+            raise